@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Load and latency benchmark of the request handlers in main.py.
+
+Boots main.application against in-memory datastore, memcache, user and
+task queue stubs, seeds it with quotes, users and votes, and then sends
+it a mix of requests like the ones the live site gets. For each route
+it reports the latency percentiles, the requests per second, and the
+number of datastore and memcache calls made per request.
+
+The stubs are much faster than the real services, so compare the RPC
+counts between runs rather than reading the latencies as production
+numbers.
+
+Usage:
+
+  python benchmarks/bench_handlers.py --sdk /path/to/google_appengine \
+      [--quotes 500] [--users 50] [--votes 2000] [--requests 2000] \
+      [--seed 1] [--json results.json]
+"""
+
+import os
+import random
+import StringIO
+import time
+import urllib
+
+import benchutil
+
+# (route name, weight, method, path, logged in) for each kind of request
+# sent. The path may contain %(quote)d for a random quote id.
+REQUEST_MIX = [
+  ('popular-anon', 30, 'GET', '/', False),
+  ('popular-user', 10, 'GET', '/', True),
+  ('recent-anon', 10, 'GET', '/recent/', False),
+  ('recent-user', 5, 'GET', '/recent/', True),
+  ('feed-popular', 10, 'GET', '/feed/popular/', False),
+  ('feed-recent', 5, 'GET', '/feed/recent/', False),
+  ('quote-anon', 8, 'GET', '/quote/%(quote)d', False),
+  ('quote-user', 2, 'GET', '/quote/%(quote)d', True),
+  ('vote', 20, 'POST', '/vote/', True),
+]
+
+
+class RpcCounter(object):
+  """Counts the API calls made, by service, through an API proxy hook."""
+
+  def __init__(self):
+    self.counts = {}
+
+  def reset(self):
+    self.counts = {}
+
+  def __call__(self, service, call, request, response):
+    self.counts[service] = self.counts.get(service, 0) + 1
+
+
+def seed(rng, quotes, voters, votes):
+  """Fill the datastore with quotes and votes, returns (quote ids, users)."""
+  from google.appengine.api import users
+  import models
+
+  people = [users.User('user%d@example.com' % i) for i in range(voters)]
+  ids = []
+  for i in range(quotes):
+    text = 'Seeded quote %d, overheard somewhere or other.' % i
+    ids.append(models.add_quote(text, rng.choice(people), _created=rng.randint(1, 30)))
+  for i in range(votes):
+    models.set_vote(rng.choice(ids), rng.choice(people), rng.choice([-1, 1]))
+  return ids, people
+
+
+def call(method, path, user, body=''):
+  """Send one request to main.application, returns the status code."""
+  import main
+
+  if user:
+    os.environ['USER_EMAIL'] = user.email()
+  else:
+    os.environ['USER_EMAIL'] = ''
+  path, query = (path.split('?', 1) + [''])[:2]
+  environ = {
+    'REQUEST_METHOD': method,
+    'PATH_INFO': path,
+    'QUERY_STRING': query,
+    'SERVER_NAME': 'localhost',
+    'SERVER_PORT': '8080',
+    'SERVER_PROTOCOL': 'HTTP/1.1',
+    'CONTENT_TYPE': 'application/x-www-form-urlencoded',
+    'CONTENT_LENGTH': str(len(body)),
+    'wsgi.version': (1, 0),
+    'wsgi.url_scheme': 'http',
+    'wsgi.input': StringIO.StringIO(body),
+    'wsgi.errors': StringIO.StringIO(),
+    'wsgi.multithread': False,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+  }
+  status = []
+  def start_response(status_line, headers, exc_info=None):
+    status.append(int(status_line.split()[0]))
+  for chunk in main.application(environ, start_response):
+    pass
+  return status[0]
+
+
+def run(rng, ids, people, requests):
+  """Send 'requests' requests picked at random from REQUEST_MIX,
+  returns a dictionary of results for each route and overall."""
+  from google.appengine.api import apiproxy_stub_map
+
+  counter = RpcCounter()
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append('bench_handlers', counter)
+  weighted = []
+  for route in REQUEST_MIX:
+    weighted.extend([route] * route[1])
+
+  samples = {}
+  started = time.time()
+  for i in range(requests):
+    name, weight, method, path, logged_in = rng.choice(weighted)
+    user = logged_in and rng.choice(people) or None
+    path = path % {'quote': rng.choice(ids)}
+    body = ''
+    if method == 'POST':
+      body = urllib.urlencode({'quoteid': rng.choice(ids), 'vote': rng.choice([-1, 1])})
+    counter.reset()
+    start = time.time()
+    status = call(method, path, user, body)
+    elapsed = time.time() - start
+    samples.setdefault(name, []).append((elapsed, status, dict(counter.counts)))
+  total = time.time() - started
+
+  results = {}
+  for name, route_samples in samples.items() + [('overall', sum(samples.values(), []))]:
+    latencies = [elapsed for (elapsed, status, counts) in route_samples]
+    services = {}
+    for elapsed, status, counts in route_samples:
+      for service, count in counts.items():
+        services[service] = services.get(service, 0) + count
+    results[name] = {
+      'requests': len(route_samples),
+      'errors': len([s for (e, s, c) in route_samples if s >= 500]),
+      'p50_ms': round(benchutil.percentile(latencies, 0.50) * 1000, 2),
+      'p95_ms': round(benchutil.percentile(latencies, 0.95) * 1000, 2),
+      'p99_ms': round(benchutil.percentile(latencies, 0.99) * 1000, 2),
+      'requests_per_second': round(len(route_samples) / max(sum(latencies), 1e-9), 1),
+      'rpcs_per_request': dict([(service, round(float(count) / len(route_samples), 2))
+                                for service, count in services.items()]),
+    }
+  results['overall']['requests_per_second'] = round(requests / total, 1)
+  return results
+
+
+def main():
+  parser = benchutil.option_parser()
+  parser.add_option('--quotes', type='int', default=500, help='Quotes to seed.')
+  parser.add_option('--users', type='int', default=50, help='Users to seed.')
+  parser.add_option('--votes', type='int', default=2000, help='Votes to seed.')
+  parser.add_option('--requests', type='int', default=2000, help='Requests to send.')
+  parser.add_option('--seed', type='int', default=1, help='Random number seed.')
+  options, args = parser.parse_args()
+  benchutil.setup_paths(parser, options)
+  benchutil.setup_stubs()
+
+  rng = random.Random(options.seed)
+  started = time.time()
+  ids, people = seed(rng, options.quotes, options.users, options.votes)
+  seed_seconds = time.time() - started
+  results = run(rng, ids, people, options.requests)
+
+  print 'Seeded %d quotes, %d users and %d votes in %.1fs' % (
+      options.quotes, options.users, options.votes, seed_seconds)
+  print '%-14s %8s %7s %9s %9s %9s %9s  %s' % (
+      'route', 'requests', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s', 'rpcs/request')
+  names = sorted([name for name in results if name != 'overall']) + ['overall']
+  for name in names:
+    result = results[name]
+    rpcs = ', '.join(['%s=%.2f' % item for item in sorted(result['rpcs_per_request'].items())])
+    print '%-14s %8d %7d %9.2f %9.2f %9.2f %9.1f  %s' % (
+        name, result['requests'], result['errors'], result['p50_ms'], result['p95_ms'],
+        result['p99_ms'], result['requests_per_second'], rpcs)
+  if options.json:
+    benchutil.write_json(options.json, {
+      'config': {
+        'quotes': options.quotes,
+        'users': options.users,
+        'votes': options.votes,
+        'requests': options.requests,
+        'seed': options.seed,
+      },
+      'routes': results,
+    })
+
+
+if __name__ == '__main__':
+  main()
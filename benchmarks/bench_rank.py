@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Compares the old string rank with the integer score quotes are paged by.
+
+Seeds quotes carrying both the zero padded rank string and the integer
+score, then reports the encoded size of each as an index value and the
+latency of fetching the first page, a deep page and a page backwards
+ordered by each property.
+
+The datastore stub keeps its indexes in memory, so the sizes are the
+useful numbers here and the latencies only show the relative cost.
+
+Usage:
+
+  python benchmarks/bench_rank.py --sdk /path/to/google_appengine \
+      [--quotes 2000] [--iterations 50] [--seed 1] [--json results.json]
+"""
+
+import random
+import time
+
+import benchutil
+
+
+def legacy_rank(quote):
+  """The rank string quotes were paged by before scores."""
+  import models
+  return '%020d|%s' % (
+    long(quote.created * models.DAY_SCALE + quote.votesum), quote.creation_order)
+
+
+def seed(rng, count):
+  """Store 'count' quotes with both a rank and a score, returns them."""
+  from google.appengine.api import users
+  from google.appengine.ext import db
+  import models
+
+  user = users.User('bench@example.com')
+  ids = [models.add_quote('Seeded quote %d.' % i, user, _created=rng.randint(1, 30))
+         for i in range(count)]
+  quotes = models.Quote.get_by_id(ids)
+  for quote in quotes:
+    quote.votesum = rng.randint(-5, 50)
+    quote.score = models._score(quote)
+    quote.rank = legacy_rank(quote)
+  db.put(quotes)
+  return quotes
+
+
+def index_value_bytes(quotes, name):
+  """Returns the mean encoded size of property 'name' over the quotes."""
+  from google.appengine.api import datastore_types
+
+  total = 0
+  for quote in quotes:
+    total += datastore_types.ToPropertyPb(name, getattr(quote, name)).ByteSize()
+  return float(total) / len(quotes)
+
+
+def time_query(gql, arg, iterations):
+  """Returns the mean milliseconds to fetch a page with the query."""
+  import models
+
+  query = models.Quote.gql(gql, arg)
+  query.fetch(models.PAGE_SIZE + 1)
+  start = time.time()
+  for i in range(iterations):
+    query.fetch(models.PAGE_SIZE + 1)
+  return (time.time() - start) * 1000 / iterations
+
+
+def run(rng, count, iterations):
+  """Returns a dictionary of results for the 'rank' and 'score' properties."""
+  quotes = seed(rng, count)
+  ordered = sorted(quotes, key=lambda quote: quote.score, reverse=True)
+  middle = ordered[len(ordered) / 2]
+  results = {}
+  for name in ['rank', 'score']:
+    cursor = getattr(middle, name)
+    results[name] = {
+      'index_value_bytes': round(index_value_bytes(quotes, name), 1),
+      'first_page_ms': round(time_query(
+          'WHERE %s <= :1 ORDER BY %s DESC' % (name, name),
+          getattr(ordered[0], name), iterations), 3),
+      'deep_page_ms': round(time_query(
+          'WHERE %s <= :1 ORDER BY %s DESC' % (name, name), cursor, iterations), 3),
+      'back_page_ms': round(time_query(
+          'WHERE %s > :1 ORDER BY %s' % (name, name), cursor, iterations), 3),
+    }
+  return results
+
+
+def main():
+  parser = benchutil.option_parser()
+  parser.add_option('--quotes', type='int', default=2000, help='Quotes to seed.')
+  parser.add_option('--iterations', type='int', default=50,
+                    help='Fetches timed per query.')
+  parser.add_option('--seed', type='int', default=1, help='Random number seed.')
+  options, args = parser.parse_args()
+  benchutil.setup_paths(parser, options)
+  benchutil.setup_stubs()
+
+  results = run(random.Random(options.seed), options.quotes, options.iterations)
+  print '%-8s %12s %14s %13s %13s' % (
+      'property', 'index bytes', 'first page ms', 'deep page ms', 'back page ms')
+  for name in ['rank', 'score']:
+    result = results[name]
+    print '%-8s %12.1f %14.3f %13.3f %13.3f' % (
+        name, result['index_value_bytes'], result['first_page_ms'],
+        result['deep_page_ms'], result['back_page_ms'])
+  if options.json:
+    benchutil.write_json(options.json, {
+      'config': {
+        'quotes': options.quotes,
+        'iterations': options.iterations,
+        'seed': options.seed,
+      },
+      'properties': results,
+    })
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Micro-benchmark of the cost of rendering each template.
+
+Renders every page template used by main.py with a full page of
+quotes, no datastore or memcache access is involved, so the numbers
+are the template overhead alone. Each template is timed through
+main.render_template(), which gets the template webapp compiled and 
+cached on first use, and with webapp's debug flag set, which loads and
+compiles it again on every render, to show what that cache saves.
+
+Usage:
+
+  python benchmarks/bench_templates.py --sdk /path/to/google_appengine \
+      [--iterations 200] [--repeat 5] [--json results.json]
+"""
+
+import os
+import time
+
+import benchutil
+
+
+def sample_values(count, section):
+  """Build the template values for a page of 'count' quotes, as seen
+  by a user who isn't logged in."""
+  from google.appengine.ext import db
+  import main
+  import models
+
+  quotes = []
+  for i in range(count):
+    quotes.append(models.Quote(
+      key=db.Key.from_path('Quote', i + 1),
+      quote='Quote number %d, which is about as long as a typical quote is.' % i,
+      uri=(i % 2) and 'http://example.com/%d' % i or None,
+      created=10,
+      creation_order='2008-10-11T12:00:%02d|%032x' % (i % 60, i),
+      votesum=count - i))
+  return {
+     'progress_id': 1,
+     'progress_msg': 'You get one star just for showing up.',
+     'greeting': '<a href="/_ah/login">Sign in to vote or add your own quote</a>.',
+     'loggedin': None,
+     'quotes': main.quote_for_template(quotes, None),
+     'section': section,
+     'nexturi': '/?offset=x&p=1',
+     'prevuri': None,
+     'updated': '2008-10-11T12:00:00Z'
+  }
+
+
+def time_render(render, iterations, repeat):
+  """Returns the best time, in microseconds, of a single call to 'render'."""
+  render()
+  best = None
+  for i in range(repeat):
+    start = time.time()
+    for j in range(iterations):
+      render()
+    elapsed = (time.time() - start) / iterations
+    if best is None or elapsed < best:
+      best = elapsed
+  return best * 1000000
+
+
+def run(iterations, repeat):
+  """Time each template, returns a list of result dictionaries."""
+  from google.appengine.ext.webapp import template
+  import main
+  import models
+
+  cases = [
+    ('index.html', models.PAGE_SIZE, 'Popular'),
+    ('recent.html', models.PAGE_SIZE, 'Recent'),
+    ('singlequote.html', 1, 'Quote'),
+    ('atom_feed.xml', models.PAGE_SIZE, 'Popular'),
+  ]
+  results = []
+  for name, count, section in cases:
+    values = sample_values(count, section)
+    path = os.path.join(main.TEMPLATE_DIR, name)
+    cached = time_render(
+        lambda: main.render_template(name, values), iterations, repeat)
+    uncached = time_render(
+        lambda: template.render(path, values, debug=True), iterations, repeat)
+    results.append({
+      'template': name,
+      'quotes': count,
+      'cached_us': round(cached, 1),
+      'uncached_us': round(uncached, 1),
+    })
+  return results
+
+
+def main():
+  parser = benchutil.option_parser()
+  parser.add_option('--iterations', type='int', default=200,
+                    help='Renders per timing run.')
+  parser.add_option('--repeat', type='int', default=5,
+                    help='Timing runs per template, the best is reported.')
+  options, args = parser.parse_args()
+  benchutil.setup_paths(parser, options)
+
+  results = run(options.iterations, options.repeat)
+  print '%-18s %6s %14s %14s' % ('template', 'quotes', 'cached (us)', 'uncached (us)')
+  for result in results:
+    print '%(template)-18s %(quotes)6d %(cached_us)14.1f %(uncached_us)14.1f' % result
+  if options.json:
+    benchutil.write_json(options.json, results)
+
+
+if __name__ == '__main__':
+  main()
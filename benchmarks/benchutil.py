@@ -0,0 +1,92 @@
+#
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Helpers shared by the benchmarks, for running the application
+outside of the development server."""
+
+import optparse
+import os
+import sys
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+APP_ID = 'just-overheard-it'
+
+
+def option_parser():
+  """Returns an OptionParser with the options every benchmark takes."""
+  parser = optparse.OptionParser()
+  parser.add_option('--sdk', default=os.environ.get('APPENGINE_SDK', ''),
+                    help='Path to the App Engine SDK.')
+  parser.add_option('--json', help='Also write the results to this file.')
+  return parser
+
+
+def setup_paths(parser, options):
+  """Put the SDK, its bundled libraries and the application on sys.path."""
+  if not options.sdk:
+    parser.error('--sdk or APPENGINE_SDK is required')
+  sys.path.insert(0, options.sdk)
+  import dev_appserver
+  dev_appserver.fix_sys_path()
+  sys.path.insert(0, APP_DIR)
+  os.environ.setdefault('APPLICATION_ID', APP_ID)
+
+
+def setup_stubs():
+  """Replace the API proxy with fresh in-memory datastore, memcache,
+  user and task queue stubs. Nothing is read from or written to disk."""
+  from google.appengine.api import apiproxy_stub_map
+  from google.appengine.api import datastore_file_stub
+  from google.appengine.api import user_service_stub
+  from google.appengine.api.memcache import memcache_stub
+  from google.appengine.api.taskqueue import taskqueue_stub
+  from google.appengine.datastore import datastore_stub_util
+
+  os.environ['APPLICATION_ID'] = APP_ID
+  os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+  os.environ.setdefault('SERVER_NAME', 'localhost')
+  os.environ.setdefault('SERVER_PORT', '8080')
+  apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+  apiproxy_stub_map.apiproxy.RegisterStub('datastore_v3', 
+      datastore_file_stub.DatastoreFileStub(APP_ID, None, None,
+          consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)))
+  apiproxy_stub_map.apiproxy.RegisterStub('memcache', memcache_stub.MemcacheService())
+  apiproxy_stub_map.apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+  apiproxy_stub_map.apiproxy.RegisterStub('taskqueue', 
+      taskqueue_stub.TaskQueueServiceStub(root_path=APP_DIR))
+
+
+def percentile(values, fraction):
+  """Returns the value at 'fraction' (0 to 1) of the way through the sorted values."""
+  if not values:
+    return 0.0
+  values = sorted(values)
+  index = int(round(fraction * (len(values) - 1)))
+  return values[index]
+
+
+def write_json(path, results):
+  """Write benchmark results to a file as JSON, with the keys sorted 
+  so that the results of two runs can be diffed."""
+  try:
+    import json
+  except ImportError:
+    from django.utils import simplejson as json
+  f = open(path, 'w')
+  try:
+    json.dump(results, f, indent=2, sort_keys=True)
+  finally:
+    f.close()
@@ -17,10 +17,21 @@ Usage:
    http://localhost:8080/test     (Modify the port if necessary.)
    
    For plain text output add '?format=plain' to the above URL.
+   To split the tests across worker processes add 'workers=4', e.g.
+   '?workers=4' or '?format=plain&workers=4'.  The HTML page then runs
+   each test class as one request split across the workers, rather than
+   each test method as a request of its own.  Where multiprocessing
+   isn't available the tests run in the server process and the results
+   say so.
    See README.TXT for information on how to run specific tests.
 
 4. The results are displayed as the tests are run.
 
+5. The tests can also be run from the command line, without the
+   development server, with the SDK named by APPENGINE_SDK:
+
+   APPENGINE_SDK=/path/to/google_appengine python gaeunit.py [--workers 4] [name]
+
 Visit http://code.google.com/p/gaeunit for more information and updates.
 
 ------------------------------------------------------------------------------
@@ -65,12 +76,28 @@ import StringIO
 import time
 import re
 import logging
+
+if __name__ == '__main__' and 'SERVER_SOFTWARE' not in os.environ:
+    # Run from the command line, find the SDK before importing from it.
+    if os.environ.get('APPENGINE_SDK'):
+        sys.path.insert(0, os.environ['APPENGINE_SDK'])
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+
 from google.appengine.ext import webapp
 from google.appengine.api import apiproxy_stub_map  
 from google.appengine.api import datastore_file_stub
+from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext.webapp.util import run_wsgi_app
 
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
 _DEFAULT_TEST_DIR = 'test'
+_NO_WORKERS_NOTE = 'multiprocessing is not available, so the tests ran in one process.'
+_SHARED_SERVICES = ['user', 'urlfetch', 'mail', 'images']
 
 
 ##############################################################################
@@ -81,7 +108,7 @@ _DEFAULT_TEST_DIR = 'test'
 class MainTestPageHandler(webapp.RequestHandler):
     def get(self):
         unknown_args = [arg for arg in self.request.arguments()
-                        if arg not in ("format", "package", "name")]
+                        if arg not in ("format", "package", "name", "workers")]
         if len(unknown_args) > 0:
             errors = []
             for arg in unknown_args:
@@ -103,20 +130,22 @@ class MainTestPageHandler(webapp.RequestHandler):
     def _render_html(self):
         suite, error = _create_suite(self.request)
         if not error:
-            self.response.out.write(_MAIN_PAGE_CONTENT % _test_suite_to_json(suite))
+            workers = int(self.request.get("workers", "1"))
+            self.response.out.write(_MAIN_PAGE_CONTENT %
+                                    (_test_suite_to_json(suite), workers))
         else:
             self.error(404)
             self.response.out.write(error)
         
     def _render_plain(self):
         self.response.headers["Content-Type"] = "text/plain"
-        runner = unittest.TextTestRunner(self.response.out)
         suite, error = _create_suite(self.request)
         if not error:
             self.response.out.write("====================\n" \
                                     "GAEUnit Test Results\n" \
                                     "====================\n\n")
-            _run_test_suite(runner, suite)
+            workers = int(self.request.get("workers", "1"))
+            _run_plain(self.response.out, suite, workers)
         else:
             self.error(404)
             self.response.out.write(error)
@@ -131,12 +160,15 @@ class JsonTestResult(unittest.TestResult):
     def __init__(self):
         unittest.TestResult.__init__(self)
         self.testNumber = 0
+        self.workers = 1
+        self.note = ''
 
     def render_to(self, stream):
         stream.write('{')
         stream.write('"runs":"%d", "total":"%d", "errors":"%d", "failures":"%d",' % \
                     (self.testsRun, self.testNumber,
                      len(self.errors), len(self.failures)))
+        stream.write('"workers":"%d", "note":"%s",' % (self.workers, self._escape(self.note)))
         stream.write('"details":')
         self._render_errors(stream)
         stream.write('}')
@@ -180,11 +212,28 @@ class JsonTestRunner:
 class JsonTestRunHandler(webapp.RequestHandler):
     def get(self):    
         test_name = self.request.get("name")
+        workers = int(self.request.get("workers", "1"))
         _load_default_test_modules()
         suite = unittest.defaultTestLoader.loadTestsFromName(test_name)
-        runner = JsonTestRunner()
-        _run_test_suite(runner, suite)
-        runner.result.render_to(self.response.out)
+        if workers > 1:
+            result = _run_test_suite_parallel(suite, workers)
+        else:
+            runner = JsonTestRunner()
+            _run_test_suite(runner, suite)
+            result = runner.result
+        result.render_to(self.response.out)
+
+
+class _TestDescription(object):
+    """Stands in for a test that was run in another process."""
+    def __init__(self, description):
+        self.description = description
+
+    def shortDescription(self):
+        return self.description
+
+    def __str__(self):
+        return self.description
 
 
 # This is not used by the HTML page, but it may be useful for other client test runners.
@@ -279,28 +328,175 @@ def _test_suite_to_json(suite):
     return str(test_dict)
 
 
+def _make_test_apiproxy(original_apiproxy=None):
+    """Create an apiproxy for running tests with an empty in-memory datastore,
+    memcache and task queue.
+
+    The stateless services are shared with original_apiproxy, the
+    development server's, if given, otherwise new stubs are created for
+    them too.
+
+    """
+    from google.appengine.api import mail_stub
+    from google.appengine.api import urlfetch_stub
+    from google.appengine.api import user_service_stub
+    from google.appengine.api.images import images_stub
+    from google.appengine.api.memcache import memcache_stub
+    from google.appengine.api.taskqueue import taskqueue_stub
+
+    apiproxy = apiproxy_stub_map.APIProxyStubMap() 
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    temp_stub = datastore_file_stub.DatastoreFileStub(
+        os.environ['APPLICATION_ID'], None, None, consistency_policy=policy)
+    apiproxy.RegisterStub('datastore_v3', temp_stub)
+    if original_apiproxy is not None:
+        # Allow the other services to be used as-is for tests.
+        for name in _SHARED_SERVICES: 
+            apiproxy.RegisterStub(name, original_apiproxy.GetStub(name))
+    else:
+        apiproxy.RegisterStub('user', user_service_stub.UserServiceStub())
+        apiproxy.RegisterStub('urlfetch', urlfetch_stub.URLFetchServiceStub())
+        apiproxy.RegisterStub('mail', mail_stub.MailServiceStub())
+        apiproxy.RegisterStub('images', images_stub.ImagesServiceStub())
+    apiproxy.RegisterStub('memcache', memcache_stub.MemcacheService())
+    apiproxy.RegisterStub('taskqueue', taskqueue_stub.TaskQueueServiceStub(
+        root_path=os.path.dirname(os.path.abspath(__file__))))
+    return apiproxy
+
+
+class _IsolatedTestSuite(unittest.TestSuite):
+    """A flat test suite that runs each test against stubs of its own.
+
+    Every test case gets a new apiproxy from _make_test_apiproxy. Dropping
+    the previous test's stubs resets the datastore, memcache and task queue
+    in constant time, however much the test stored, and nothing is written
+    to disk. Tests needn't clean up after themselves.
+
+    """
+    def __init__(self, suite, original_apiproxy=None):
+        tests = []
+        _get_tests_from_suite(suite, tests)
+        unittest.TestSuite.__init__(self, tests)
+        self.original_apiproxy = original_apiproxy
+
+    def run(self, result):
+        for test in self._tests:
+            if result.shouldStop:
+                break
+            apiproxy_stub_map.apiproxy = _make_test_apiproxy(self.original_apiproxy)
+            test(result)
+        return result
+
+
 def _run_test_suite(runner, suite):
     """Run the test suite.
 
-    Preserve the current development apiproxy, create a new apiproxy and
-    replace the datastore with a temporary one that will be used for this
-    test suite, run the test suite, and restore the development apiproxy.
-    This isolates the test datastore from the development datastore.
+    Preserve the current development apiproxy, run each test with a new
+    apiproxy whose datastore, memcache and task queue are temporary ones
+    used for that test alone, and restore the development apiproxy.
+    This isolates the test data from the development data.
 
     """        
     original_apiproxy = apiproxy_stub_map.apiproxy
     try:
-       apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap() 
-       temp_stub = datastore_file_stub.DatastoreFileStub('GAEUnitDataStore', None, None)  
-       apiproxy_stub_map.apiproxy.RegisterStub('datastore', temp_stub)
-       # Allow the other services to be used as-is for tests.
-       for name in ['user', 'urlfetch', 'mail', 'memcache', 'images']: 
-           apiproxy_stub_map.apiproxy.RegisterStub(name, original_apiproxy.GetStub(name))
-       runner.run(suite)
+       runner.run(_IsolatedTestSuite(suite, original_apiproxy))
     finally:
        apiproxy_stub_map.apiproxy = original_apiproxy
 
 
+def _test_name(test):
+    return '%s.%s.%s' % (type(test).__module__, type(test).__name__, test._testMethodName)
+
+
+def _run_test_names(names):
+    """Run the named tests in a worker process with stubs of its own.
+
+    Returns (tests run, errors, failures), with each error and failure a
+    (description, traceback) pair, since the tests themselves can't be
+    sent back to the parent process.
+
+    """
+    _load_default_test_modules()
+    suite = unittest.defaultTestLoader.loadTestsFromNames(names)
+    result = unittest.TestResult()
+    _IsolatedTestSuite(suite).run(result)
+    describe = JsonTestResult()._description
+    return (result.testsRun,
+            [(describe(test), err) for test, err in result.errors],
+            [(describe(test), err) for test, err in result.failures])
+
+
+def _run_test_suite_parallel(suite, workers):
+    """Run the test suite split across a pool of worker processes.
+
+    The tests are dealt out round robin to the workers, each of which
+    runs its share with stubs of its own for each test. Returns
+    a JsonTestResult holding the merged results, with workers set to the
+    number of processes used. Falls back to running the tests in this
+    process where multiprocessing isn't available, as in the development
+    server's sandbox, noting that in the result.
+
+    """
+    tests = []
+    _get_tests_from_suite(suite, tests)
+    result = JsonTestResult()
+    result.testNumber = len(tests)
+    pool = None
+    if workers > 1 and len(tests) > 1:
+        chunk_count = min(workers, len(tests))
+        if multiprocessing is not None:
+            try:
+                pool = multiprocessing.Pool(chunk_count)
+            except (ImportError, OSError, NotImplementedError), e:
+                logging.warning('Could not start worker processes: %s', e)
+    if pool is None:
+        runner = JsonTestRunner()
+        _run_test_suite(runner, suite)
+        runner.result.testNumber = len(tests)
+        if workers > 1 and len(tests) > 1:
+            runner.result.note = _log_error(_NO_WORKERS_NOTE)
+        return runner.result
+    names = [_test_name(test) for test in tests]
+    chunks = [names[i::workers] for i in range(chunk_count)]
+    result.workers = chunk_count
+    try:
+        outputs = pool.map(_run_test_names, chunks)
+    finally:
+        pool.close()
+        pool.join()
+    for runs, errors, failures in outputs:
+        result.testsRun += runs
+        result.errors.extend([(_TestDescription(desc), err) for desc, err in errors])
+        result.failures.extend([(_TestDescription(desc), err) for desc, err in failures])
+    return result
+
+
+def _run_plain(stream, suite, workers=1):
+    """Run the test suite, writing the results as plain text to stream."""
+    if workers < 2:
+        _run_test_suite(unittest.TextTestRunner(stream), suite)
+        return
+    start = time.time()
+    result = _run_test_suite_parallel(suite, workers)
+    elapsed = time.time() - start
+    for flavour, errors in [('ERROR', result.errors), ('FAIL', result.failures)]:
+        for test, err in errors:
+            stream.write('=' * 70 + '\n')
+            stream.write('%s: %s\n' % (flavour, test))
+            stream.write('-' * 70 + '\n')
+            stream.write('%s\n' % err)
+    stream.write('-' * 70 + '\n')
+    if result.note:
+        stream.write('%s\n' % result.note)
+    stream.write('Ran %d tests in %.3fs with %d workers\n\n' % 
+                 (result.testsRun, elapsed, result.workers))
+    if result.wasSuccessful():
+        stream.write('OK\n')
+    else:
+        stream.write('FAILED (failures=%d, errors=%d)\n' % 
+                     (len(result.failures), len(result.errors)))
+
+
 def _log_error(s):
    logging.warn(s)
    return s
@@ -326,9 +522,11 @@ _MAIN_PAGE_CONTENT = """
         #errorarea {padding-top:25px}
         .error {border-color: #c3d9ff; border-style: solid; border-width: 2px 1px 2px 1px; width:750px; padding:1px; margin:0pt auto; text-align:left}
         .errtitle {background-color:#c3d9ff; font-weight:bold}
+        #notearea {padding-top:10px; font-style:italic}
     </style>
     <script language="javascript" type="text/javascript">
         var testsToRun = eval("(" + "%s" + ")"); // JSON-formatted (see _test_suite_to_json)
+        var workers = %d; // Worker processes for each /testrun request
         var totalRuns = 0;
         var totalErrors = 0;
         var totalFailures = 0;
@@ -346,8 +544,13 @@ _MAIN_PAGE_CONTENT = """
             if (methodName) {
                 methodSuffix = "." + methodName;
             }
+            var workersSuffix = "";
+            if (workers > 1) {
+                workersSuffix = "&workers=" + workers;
+            }
             var xmlHttp = newXmlHttp();
-            xmlHttp.open("GET", "/testrun?name=" + moduleName + "." + className + methodSuffix, true);
+            xmlHttp.open("GET", "/testrun?name=" + moduleName + "." + className + methodSuffix +
+                         workersSuffix, true);
             xmlHttp.onreadystatechange = function() {
                 if (xmlHttp.readyState != 4) {
                     return;
@@ -360,6 +563,9 @@ _MAIN_PAGE_CONTENT = """
                     document.getElementById("testran").innerHTML = totalRuns;
                     document.getElementById("testerror").innerHTML = totalErrors;
                     document.getElementById("testfailure").innerHTML = totalFailures;
+                    if (result.note) {
+                        document.getElementById("notearea").innerHTML = result.note;
+                    }
                     if (totalErrors == 0 && totalFailures == 0) {
                         testSucceed();
                     } else {
@@ -405,12 +611,14 @@ _MAIN_PAGE_CONTENT = """
             for (var moduleName in testsToRun) {
                 var classes = testsToRun[moduleName];
                 for (var className in classes) {
-                    // TODO: Optimize for the case where tests are run by class so we don't
-                    //       have to always execute each method separately.  This should be
-                    //       possible when we have a UI that allows the user to select tests
-                    //       by module, class, and method.
-                    //requestTestRun(moduleName, className);
                     methods = classes[className];
+                    if (workers > 1) {
+                        // Run the whole class in one request so the server can split
+                        // its methods across the worker processes.
+                        totalTests += methods.length;
+                        requestTestRun(moduleName, className);
+                        continue;
+                    }
                     for (var i = 0; i < methods.length; i++) {
                         totalTests += 1;
                         var methodName = methods[i];
@@ -439,6 +647,7 @@ _MAIN_PAGE_CONTENT = """
             </tr>
         </tbody></table>
     </div>
+    <div id="notearea"></div>
     <div id="errorarea"></div>
     <div id="footerarea">
         <div id="weblink">
@@ -468,7 +677,9 @@ application = webapp.WSGIApplication([('/test', MainTestPageHandler),
                                       debug=True)
 
 def main():
-  if os.environ['SERVER_SOFTWARE'].startswith('Development'):
+  if 'SERVER_SOFTWARE' not in os.environ:
+    _main_cli(sys.argv[1:])
+  elif os.environ['SERVER_SOFTWARE'].startswith('Development'):
     run_wsgi_app(application)                                    
   else:
     print 'Status: 404 Not Found'
@@ -477,5 +688,39 @@ def main():
     print 'Not Found'
     return
 
+
+def _main_cli(args):
+    """Run the tests from the command line.
+
+    Usage: gaeunit.py [--workers N] [--format plain|json] [test name ...]
+
+    """
+    import optparse
+    parser = optparse.OptionParser(usage='%prog [options] [test name ...]')
+    parser.add_option('--workers', type='int', default=1,
+                      help='Number of worker processes to run the tests in.')
+    parser.add_option('--format', default='plain', choices=['plain', 'json'],
+                      help='Write the results as plain text or JSON.')
+    options, names = parser.parse_args(args)
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    os.environ.setdefault('APPLICATION_ID', 'gaeunit')
+    os.environ.setdefault('AUTH_DOMAIN', 'gmail.com')
+    os.environ.setdefault('SERVER_NAME', 'localhost')
+    os.environ.setdefault('SERVER_PORT', '8080')
+    os.environ.setdefault('USER_EMAIL', '')
+    loader = unittest.defaultTestLoader
+    modules = _load_default_test_modules()
+    if names:
+        suite = loader.loadTestsFromNames(names)
+    else:
+        suite = unittest.TestSuite([loader.loadTestsFromModule(m) for m in modules])
+    apiproxy_stub_map.apiproxy = _make_test_apiproxy()
+    if options.format == 'json':
+        result = _run_test_suite_parallel(suite, options.workers)
+        result.render_to(sys.stdout)
+        sys.stdout.write('\n')
+    else:
+        _run_plain(sys.stdout, suite, options.workers)
+
 if __name__ == '__main__':
     main()
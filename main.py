@@ -21,9 +21,9 @@ Overheard allows users to add quotes and vote on them, with
 the most popular rising to the top of the rankings.
 
 Demonstrates:
-   * Paging   - both using fetch() and by a unique index
+   * Paging   - by a unique index, forwards and backwards
    * Decay    - Having older quotes fall from view over time without background processes
-   * Sharding - Using per user count shards to create unique a unique index
+   * Sharding - Spreading the votes of busy quotes across QuoteVoteShards
    * Memcache
 
 Decay:
@@ -32,6 +32,11 @@ Decay:
   Votes will be created with the Quote they are about as their parent. 
   As new votes are added the rank and votesum for the parent Quote are updated.
 
+  A quote created while models.VOTE_SHARDS is non-zero instead keeps its 
+  votes in that many QuoteVoteShard entity groups, and the votesum and rank 
+  of the Quote are summed up from the shards at most every ROLLUP_INTERVAL 
+  seconds. The rank is calculated the same way either way.
+
   We don't have background tasks that can go back and adjust the current rankings 
   of quotes over time, so we need a way to rank quotes that puts fresher quotes 
   higher in the ranking in a scalable way that will work for a long period of time.
@@ -71,20 +76,60 @@ Decay:
 
   Note that ties are possible, which means that rank for quotes will have 
   to be disambiguated since the application allows paging of ranked quotes.
+  The rank is stored shifted left 31 bits with the low 31 bits of the quote 
+  id in the space made, as a single integer 'score' property that is small 
+  in the index:
+
+     score = rank << 31 | (id & (2**31 - 1))
+
+  add_quote() allocates ids in increasing order, so among those quotes the
+  score is unique and quotes of equal rank sort newest first. Quotes stored
+  before that have scattered, automatically assigned ids, so their ties 
+  are broken in no particular order, and two of them could even share 
+  a score.
+
+  Quotes stored before there was a score are given one by the rerank 
+  mapper, which has to finish before the score queries serve traffic, 
+  see README.md.
 
    
 """
 
 import cgi
+import email.utils
 import logging
 import os
+import time
+import urllib
 import urlparse
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 import models
+import ratelimit
+import rpcstats
 import wsgiref.handlers
 
+try:
+  import json
+except ImportError:
+  from django.utils import simplejson as json
+
+# Seconds a rendered page is kept for anonymous users. Pages are
+# normally thrown away well before this by a change in 
+# models.list_generation(), this is just a safety net.
+PAGE_CACHE_TTL = 60
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), 'templates')
+
+
+def render_template(name, template_values):
+  """Render a template from the templates directory with the given values.
+  webapp keeps each template compiled after its first use, so this only
+  saves the handlers building the path."""
+  return template.render(os.path.join(TEMPLATE_DIR, name), template_values)
+
 def get_greeting():
   """
   Generate HTML for the user to either logout or login,
@@ -138,11 +183,12 @@ def quote_for_template(quotes, user, page=0):
   """
   quotes_tpl = []
   index = 1 + page * models.PAGE_SIZE
-  for quote in quotes:
+  votes = models.voted_multi(quotes, user)
+  for quote, vote in zip(quotes, votes):
     quotes_tpl.append({
       'id': quote.key().id(),
       'uri': quote.uri,
-      'voted': models.voted(quote, user),
+      'voted': vote,
       'quote': quote.quote,
       'creator': quote.creator,
       'created': quote.creation_order[:10],
@@ -153,6 +199,20 @@ def quote_for_template(quotes, user, page=0):
     index += 1
   return quotes_tpl
 
+def quote_for_json(quote):
+  """Convert a Quote object into a dictionary for the JSON API.
+  Only includes what is the same for every user, so the creator
+  is left out.
+  """
+  return {
+    'id': quote.key().id(),
+    'quote': quote.quote,
+    'uri': quote.uri,
+    'created': quote.creation_order[:10],
+    'votesum': quote.votesum
+  }
+
+
 def create_template_dict(user, quotes, section, nexturi=None, prevuri=None, page=0):
   """Bundle up all the values and generate a dictionary that can be used to 
   instantiate a base + base_quotelist template.
@@ -184,22 +244,172 @@ def create_template_dict(user, quotes, section, nexturi=None, prevuri=None, page
   return template_values
 
 
+def rate_limited(handler, limit, user, cost=1):
+  """Answer the request with a 429 and return True if it is over 'limit'."""
+  email = user and user.email() or None
+  if limit.allow(email, handler.request.remote_addr, cost):
+    return False
+  handler.response.set_status(429, 'Too Many Requests')
+  handler.response.headers['Retry-After'] = str(limit.period)
+  return True
+
+
+def score_param(value):
+  """Returns a score or position passed as a paging parameter, or None 
+  if it is missing or not a number."""
+  if not value:
+    return None
+  try:
+    return long(value)
+  except ValueError:
+    return None
+
+
+def page_cache_key(section, page):
+  """Build the memcache key for a rendered page. 
+
+  The key includes the current generation of the quote lists, so 
+  any vote, new quote or deletion moves all the pages on to new keys.
+  The key must be computed before the quotes are read so that a page 
+  rendered from old data is never stored under a newer generation.
+
+  Args
+    section:  The name of the section, e.g. 'popular' or 'feed-recent'.
+    page:     Anything else the page depends on, such as the paging parameters.
+  """
+  return 'page|%d|%s|%s' % (models.list_generation(), section, page)
+
+
+def get_cached_page(key):
+  """Return the cached body for the page key or None, counting hits and misses."""
+  body = memcache.get(key)
+  if body is not None:
+    memcache.incr('pagecache|hits', initial_value=0)
+  else:
+    memcache.incr('pagecache|misses', initial_value=0)
+  return body
+
+
+def set_cached_page(key, body):
+  """Store a rendered page body."""
+  memcache.set(key, body, time=PAGE_CACHE_TTL)
+
+
+def page_cache_stats():
+  """Returns (hits, misses) for the rendered page cache."""
+  counts = memcache.get_multi(['hits', 'misses'], key_prefix='pagecache|')
+  return counts.get('hits', 0), counts.get('misses', 0)
+
+
+def not_modified(handler, section, changed=None):
+  """Handle a conditional GET for a page built from the quotes in a section.
+
+  Sets the ETag and Last-Modified headers from models.last_changed(), and
+  if the request shows the client already has the current version sets 
+  a 304 status. Only use this for responses that are the same for 
+  every user.
+
+  Args
+    handler:  The RequestHandler serving the page.
+    section:  Which quotes the page is built from, 'popular' or 'recent'.
+    changed:  When the version of the quotes being served last changed,
+                if it isn't the current one.
+
+  Returns
+    True if a 304 was set and nothing more needs to be written.
+  """
+  if changed is None:
+    changed = models.last_changed(section)
+  etag = '"%s-%.6f"' % (section, changed)
+  handler.response.headers['ETag'] = etag
+  handler.response.headers['Last-Modified'] = email.utils.formatdate(changed, usegmt=True)
+  if_none_match = handler.request.headers.get('If-None-Match')
+  if_modified_since = handler.request.headers.get('If-Modified-Since')
+  if if_none_match:
+    tags = [tag.strip() for tag in if_none_match.split(',')]
+    current = etag in tags or '*' in tags
+  elif if_modified_since:
+    since = email.utils.parsedate_tz(if_modified_since)
+    current = since is not None and email.utils.mktime_tz(since) >= int(changed)
+  else:
+    current = False
+  if current:
+    handler.response.set_status(304, 'Not Modified')
+  return current
+
+
+def per_user_page(handler):
+  """Mark a page whose URL serves different HTML once the user signs in.
+  Browsers must revalidate it on every view, so the ETag and Last-Modified
+  of a signed out copy never let it be shown after signing in."""
+  handler.response.headers['Cache-Control'] = 'no-cache'
+  handler.response.headers['Vary'] = 'Cookie'
+
+
+def stale_page(handler, section, stale, cache_section, page):
+  """Handle a request for a page built from a list that models.get_list()
+  returned as stale, read at the time 'stale'.
+
+  The page is older than the version not_modified() described, so the
+  conditional GET is handled again for the version it does show, and a 
+  page already rendered from that version is looked for in the page cache
+  under a key of its own, which doesn't change with the list generation.
+
+  Args
+    handler:        The RequestHandler serving the page.
+    section:        Which quotes the page is built from, 'popular' or 'recent'.
+    stale:          When the stale list was read.
+    cache_section:  As for page_cache_key().
+    page:           As for page_cache_key().
+
+  Returns
+    (done, cache_key), done is True if the response has been written, 
+    otherwise the rendered page is to be stored under cache_key.
+  """
+  if not_modified(handler, section, stale):
+    return True, None
+  cache_key = 'page|stale|%.6f|%s|%s' % (stale, cache_section, page)
+  body = get_cached_page(cache_key)
+  if body is not None:
+    handler.response.out.write(body)
+    return True, cache_key
+  return False, cache_key
+
+
 class MainHandler(webapp.RequestHandler):
   """Handles the main page and adding new quotes."""
 
   def get(self):
     """The most popular quotes in order, broken into pages, 
        served as HTML."""
+    per_user_page(self)
     user = users.get_current_user()
     page = int(self.request.get('p', '0'))
-    quotes, next = models.get_quotes(page)
+    offset = score_param(self.request.get('offset'))
+    before = score_param(self.request.get('before'))
+    if not user:
+      if not_modified(self, 'popular'):
+        return
+      page_id = '%s|%s|%d' % (offset, before, page)
+      cache_key = page_cache_key('popular', page_id)
+      body = get_cached_page(cache_key)
+      if body is not None:
+        self.response.out.write(body)
+        return
+      quotes, next, stale = models.get_list('popular', offset, before)
+      if stale:
+        done, cache_key = stale_page(self, 'popular', stale, 'popular', page_id)
+        if done:
+          return
+    else:
+      quotes, next = models.get_quotes(offset, before)
     if next:
-      nexturi = '/?p=%d' % (page + 1)
+      nexturi = '/?offset=%d&p=%d' % (next, page + 1)
     else:
       nexturi = None
-    if page > 1:
-      prevuri = '/?p=%d' % (page - 1)
-    elif page == 1:
+    if page > 1 and quotes:
+      prevuri = '/?before=%d&p=%d' % (quotes[0].score, page - 1)
+    elif page >= 1:
       prevuri = '/'
     else:
       prevuri = None
@@ -207,12 +417,16 @@ class MainHandler(webapp.RequestHandler):
     template_values = create_template_dict(
         user, quotes, 'Popular', nexturi, prevuri, page
       )    
-    template_file = os.path.join(os.path.dirname(__file__), 'templates/index.html')    
-    self.response.out.write(template.render(template_file, template_values))
+    body = render_template('index.html', template_values)
+    if not user:
+      set_cached_page(cache_key, body)
+    self.response.out.write(body)
     
   def post(self):
     """Add a quote to the system."""
     user = users.get_current_user()
+    if rate_limited(self, ratelimit.QUOTES, user):
+      return
     text = self.request.get('newtidbit').strip()
     if len(text) > 500:
       text = text[:500]
@@ -234,15 +448,16 @@ class MainHandler(webapp.RequestHandler):
          'uri' : uri,
          'error_msg' : 'The supplied link is not a valid absolute URI'
       }
-      template_file = os.path.join(os.path.dirname(__file__), 
-          'templates/add_quote_error.html'
-      )
-      self.response.out.write(template.render(template_file, template_values))
+      self.response.out.write(render_template('add_quote_error.html', template_values))
     else:
-      quote_id = models.add_quote(text, user, uri=uri)
+      quote_id, added = models.add_or_find_quote(text, user, uri=uri)
       if quote_id is not None:
         models.set_vote(long(quote_id), user, 1)
-        self.redirect('/recent/')
+        if added:
+          self.redirect('/recent/')
+        else:
+          # Show the existing quote the vote went to.
+          self.redirect('/quote/%d' % quote_id)
       else:
         template_values  = {
            'progress_id': progress_id,
@@ -253,10 +468,7 @@ class MainHandler(webapp.RequestHandler):
            'uri' : uri,
            'error_msg' : 'An error occured while adding this quote, please try again.'
         }
-        template_file = os.path.join(os.path.dirname(__file__), 
-            'templates/add_quote_error.html'
-          )    
-        self.response.out.write(template.render(template_file, template_values))        
+        self.response.out.write(render_template('add_quote_error.html', template_values))
 
 
 class VoteHandler (webapp.RequestHandler):
@@ -268,13 +480,56 @@ class VoteHandler (webapp.RequestHandler):
     if None == user:
       self.response.set_status(403, 'Forbidden')
       return
+    if rate_limited(self, ratelimit.VOTES, user):
+      return
     quoteid = self.request.get('quoteid')
     vote = self.request.get('vote')
     if not vote in ['1', '-1']:
       self.response.set_status(400, 'Bad Request')
       return
     vote = int(vote)
-    models.set_vote(long(quoteid), user, vote)
+    if models.VOTE_WRITE_BEHIND:
+      models.enqueue_vote(long(quoteid), user, vote)
+    else:
+      models.set_vote(long(quoteid), user, vote)
+
+
+class BatchVoteHandler (webapp.RequestHandler):
+  """Handles AJAX requests carrying many votes at once."""
+
+  # The most votes accepted in a single request.
+  MAX_VOTES = 100
+
+  def post(self):
+    """Add or change several votes for a user.
+    
+    Takes repeated 'quoteid' and 'vote' parameters, paired up in 
+    order, and returns a JSON list with a result for each pair.
+    """
+    user = users.get_current_user()
+    if None == user:
+      self.response.set_status(403, 'Forbidden')
+      return
+    quoteids = self.request.get_all('quoteid')
+    votes = self.request.get_all('vote')
+    if (not quoteids or len(quoteids) != len(votes) or len(votes) > self.MAX_VOTES
+        or [q for q in quoteids if not q.isdigit()]
+        or [v for v in votes if v not in ['1', '-1']]):
+      self.response.set_status(400, 'Bad Request')
+      return
+    if rate_limited(self, ratelimit.VOTES, user, len(votes)):
+      return
+    votes = [(long(quoteid), int(vote)) for quoteid, vote in zip(quoteids, votes)]
+    if models.VOTE_WRITE_BEHIND:
+      for quoteid, vote in votes:
+        models.enqueue_vote(quoteid, user, vote)
+      results = ['queued'] * len(votes)
+    else:
+      results = models.set_votes(user, votes)
+    self.response.headers['Content-Type'] = 'application/json'
+    self.response.out.write(json.dumps(
+        [{'quoteid': quoteid, 'result': result} 
+         for ((quoteid, vote), result) in zip(votes, results)]))
 
 
 class RecentHandler(webapp.RequestHandler):
@@ -282,21 +537,81 @@ class RecentHandler(webapp.RequestHandler):
 
   def get(self):
     """Retrieve an HTML page of the most recently added quotes."""
+    per_user_page(self)
     user = users.get_current_user()
     offset = self.request.get('offset')
     page = int(self.request.get('p', '0'))
     logging.info('Latest offset = %s' % offset)
     if not offset:
       offset = None
-    quotes, next = models.get_quotes_newest(offset)
+    if not user:
+      if not_modified(self, 'recent'):
+        return
+      page_id = '%s|%d' % (offset, page)
+      cache_key = page_cache_key('recent', page_id)
+      body = get_cached_page(cache_key)
+      if body is not None:
+        self.response.out.write(body)
+        return
+      quotes, next, stale = models.get_list('recent', offset)
+      if stale:
+        done, cache_key = stale_page(self, 'recent', stale, 'recent', page_id)
+        if done:
+          return
+    else:
+      quotes, next = models.get_quotes_newest(offset)
     if next:
       nexturi = '?offset=%s&p=%d' % (next, page+1)
     else:
       nexturi = None
 
     template_values = create_template_dict(user, quotes, 'Recent', nexturi, prevuri=None, page=page)
-    template_file = os.path.join(os.path.dirname(__file__), 'templates/recent.html')    
-    self.response.out.write(template.render(template_file, template_values))
+    body = render_template('recent.html', template_values)
+    if not user:
+      set_cached_page(cache_key, body)
+    self.response.out.write(body)
+
+
+class SearchHandler(webapp.RequestHandler):
+  """Handles searching the text of the quotes."""
+
+  def get(self):
+    """Retrieve an HTML page of the quotes containing all the words in 'q'."""
+    user = users.get_current_user()
+    query = self.request.get('q')
+    cursor = self.request.get('cursor') or None
+    page = int(self.request.get('p', '0'))
+    quotes, next = models.search_quotes(query, cursor)
+    if next:
+      nexturi = '/search?%s' % urllib.urlencode(
+          {'q': query.encode('utf-8'), 'cursor': next, 'p': page + 1})
+    else:
+      nexturi = None
+    template_values = create_template_dict(user, quotes, 'Search', nexturi, prevuri=None, page=page)
+    template_values['query'] = query
+    self.response.out.write(render_template('search.html', template_values))
+
+
+class MineHandler(webapp.RequestHandler):
+  """Handles the lists of the quotes the user added and voted on."""
+
+  def get(self, name):
+    """Retrieve an HTML page of the users 'quotes' or 'votes', 
+    the most recent first."""
+    user = users.get_current_user()
+    if None == user:
+      self.redirect(users.create_login_url(self.request.uri))
+      return
+    page = int(self.request.get('p', '0'))
+    cursor = score_param(self.request.get('cursor'))
+    quotes, next = models.get_user_quotes(user, name, cursor)
+    if next:
+      nexturi = '/me/%s?cursor=%d&p=%d' % (name, next, page + 1)
+    else:
+      nexturi = None
+    template_values = create_template_dict(user, quotes, 'Mine', nexturi, prevuri=None, page=page)
+    template_values['list'] = name
+    self.response.out.write(render_template('mine.html', template_values))
 
 
 class FeedHandler(webapp.RequestHandler):
@@ -305,18 +620,30 @@ class FeedHandler(webapp.RequestHandler):
   def get(self, section):
     """Retrieve a feed"""
     user = None
-    if section == 'recent':    
-      quotes, next = models.get_quotes_newest()
-    elif section == 'popular':
-      quotes, next = models.get_quotes()
-    else:
+    if section not in ['recent', 'popular']:
       self.response.set_status(404, 'Not Found')
       return      
+    self.response.headers['Content-Type'] = 'application/atom+xml; charset=utf-8'
+    if not_modified(self, section):
+      return
+    cache_key = page_cache_key('feed-' + section, '')
+    body = get_cached_page(cache_key)
+    if body is not None:
+      self.response.out.write(body)
+      return
+
+    quotes, next, stale = models.get_list(section)
+    if stale:
+      done, cache_key = stale_page(self, section, stale, 'feed-' + section, '')
+      if done:
+        return
 
     template_values = create_template_dict(user, quotes, section.capitalize())
-    template_file = os.path.join(os.path.dirname(__file__), 'templates/atom_feed.xml')    
-    self.response.headers['Content-Type'] = 'application/atom+xml; charset=utf-8'
-    self.response.out.write(template.render(template_file, template_values))
+    template_values['updated'] = time.strftime('%Y-%m-%dT%H:%M:%SZ', 
+        time.gmtime(stale or models.last_changed(section)))
+    body = render_template('atom_feed.xml', template_values)
+    set_cached_page(cache_key, body)
+    self.response.out.write(body)
 
 
 class QuoteHandler (webapp.RequestHandler):
@@ -338,17 +665,164 @@ class QuoteHandler (webapp.RequestHandler):
     quotes = [quote]
 
     template_values = create_template_dict(user, quotes, 'Quote', nexturi=None, prevuri=None, page=0)
-    template_file = os.path.join(os.path.dirname(__file__), 'templates/singlequote.html')
-    self.response.out.write(template.render(template_file, template_values))
+    self.response.out.write(render_template('singlequote.html', template_values))
 
-application = webapp.WSGIApplication(
+class MapperHandler(webapp.RequestHandler):
+  """Runs the mappers in models.MAPPERS a batch per task. An admin can 
+  visit it with the mapper's 'name' to see its progress, adding 
+  'start=1' to begin a new run or 'resume=1' to carry on a stopped run
+  from its last checkpoint."""
+
+  def get(self):
+    mapper = models.MAPPERS.get(self.request.get('name'))
+    if mapper is None:
+      self.error(404)
+      return
+    if self.request.get('start'):
+      state = mapper.start()
+    elif self.request.get('resume'):
+      state = mapper.resume()
+    else:
+      state = mapper.state()
+    self.response.headers['Content-Type'] = 'text/plain'
+    if state is None:
+      self.response.out.write('%s never run\n' % mapper.NAME)
+      return
+    self.response.out.write(
+        '%s run %d: %d batches, %d processed, %d changed, %.1f per second%s\n' % (
+        mapper.NAME, state.run, state.batches, state.processed, state.changed, 
+        state.rate(), state.done and ', done' or ''))
+
+  def post(self):
+    mapper = models.MAPPERS[self.request.get('name')]
+    run = long(self.request.get('run'))
+    batch = long(self.request.get('batch'))
+    state = mapper.run_batch(run, batch)
+    if state is None:
+      # An earlier attempt of this task did the batch, but may have failed
+      # to queue the next one. The task name stops it being queued twice.
+      state = mapper.state()
+      if state is None or state.run != run or state.batches != batch + 1:
+        return
+    else:
+      logging.info('Mapper %s: %d processed, %d changed, %.1f per second' % (
+          mapper.NAME, state.processed, state.changed, state.rate()))
+    if not state.done:
+      mapper.schedule(state, countdown=mapper.THROTTLE)
+
+
+class RollupHandler(webapp.RequestHandler):
+  """Task queue handler that brings the votesum of a sharded quote up to date."""
+
+  def post(self):
+    models.rollup_votes(long(self.request.get('id')))
+
+
+class RefreshListHandler(webapp.RequestHandler):
+  """Task queue handler that reads a stale page of a list for models.get_list()."""
+
+  def post(self):
+    section = self.request.get('section')
+    if section == 'popular':
+      models.refresh_list(section, score_param(self.request.get('offset')), 
+                          score_param(self.request.get('before')))
+    elif section == 'recent':
+      models.refresh_list(section, self.request.get('offset') or None)
+
+
+class DrainVotesHandler(webapp.RequestHandler):
+  """Cron handler that applies the queued votes, those queued by VoteHandler
+  and those on hot quotes, then demotes the hot quotes that have cooled."""
+
+  # Limit on the number of batches applied in a single request.
+  MAX_BATCHES = 10
+
+  def get(self):
+    queued = {}
+    for i in range(self.MAX_BATCHES):
+      if models.drain_votes(queued=queued) < models.VOTE_BATCH_SIZE:
+        break
+    models.cool_hot_quotes(queued)
+
+
+class ApiQuotesHandler(webapp.RequestHandler):
+  """JSON list of quotes, the same for every user so it is cached for all."""
+
+  def get(self):
+    """Returns a page of quotes from a section as JSON, along with the 
+    cursor for the following page, or null if it is the last page."""
+    section = self.request.get('section', 'popular')
+    cursor = self.request.get('cursor') or None
+    if section not in ['popular', 'recent']:
+      self.response.set_status(400, 'Bad Request')
+      return
+    self.response.headers['Content-Type'] = 'application/json'
+    if not_modified(self, section):
+      return
+    cache_key = page_cache_key('api-' + section, cursor)
+    body = get_cached_page(cache_key)
+    if body is None:
+      page = cursor
+      if section == 'popular':
+        cursor = score_param(cursor)
+      quotes, next, stale = models.get_list(section, cursor)
+      if stale:
+        done, cache_key = stale_page(self, section, stale, 'api-' + section, page)
+        if done:
+          return
+      body = json.dumps({
+        'quotes': [quote_for_json(quote) for quote in quotes], 
+        'next': next
+      })
+      set_cached_page(cache_key, body)
+    self.response.out.write(body)
+
+
+class StatsHandler(webapp.RequestHandler):
+  """Admin only page of cache and API call statistics, access is restricted in app.yaml."""
+
+  def get(self):
+    """Report the page cache hit ratio, the requests rejected by the rate 
+    limits, the quotes made hot by contention and the API calls made 
+    per request."""
+    hits, misses = page_cache_stats()
+    ratio = 0.0
+    if hits + misses:
+      ratio = float(hits) / (hits + misses)
+    requests, totals = rpcstats.get_totals()
+    mappers = sorted(models.MAPPERS.keys())
+    for total in totals:
+      total['per_request'] = '%.2f' % (float(total['count']) / max(requests, 1))
+    template_values = {
+      'hits': hits,
+      'misses': misses,
+      'hit_ratio': '%.3f' % ratio,
+      'requests': requests,
+      'rpcs': totals,
+      'rejections': ratelimit.get_rejections(),
+      'contention': models.contention_stats(),
+      'mappers': zip(mappers, models.MapperState.get_by_key_name(mappers))
+    }
+    self.response.out.write(render_template('stats.html', template_values))
+
+
+application = rpcstats.RpcStatsMiddleware(webapp.WSGIApplication(
     [
         ('/', MainHandler),
         ('/vote/', VoteHandler),
+        ('/vote/batch/', BatchVoteHandler),
         ('/recent/', RecentHandler),
+        ('/search', SearchHandler),
+        ('/me/(quotes|votes)', MineHandler),
         ('/quote/(.*)', QuoteHandler),
         ('/feed/(recent|popular)/', FeedHandler),
-    ], debug=True)
+        ('/api/quotes', ApiQuotesHandler),
+        ('/_stats', StatsHandler),
+        ('/_tasks/rollup', RollupHandler),
+        ('/_tasks/mapper', MapperHandler),
+        ('/_tasks/drain_votes', DrainVotesHandler),
+        ('/_tasks/refresh_list', RefreshListHandler),
+    ], debug=True))
 
 def main():
   wsgiref.handlers.CGIHandler().run(application)
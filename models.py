@@ -19,15 +19,123 @@ Quotes, Votes and Voters in the Overheard application.
 """
 
 
+import bisect
 import datetime
 import hashlib
+import logging
+import re
+import threading
+import time
+import uuid
 
 from google.appengine.ext import db
 from google.appengine.api import memcache
+from google.appengine.api import taskqueue
 from google.appengine.api import users
+from google.appengine.datastore import entity_pb
 
 PAGE_SIZE = 20
 DAY_SCALE = 4
+LIST_GENERATION_KEY = "lists|generation"
+
+# Quotes are ordered by a 64-bit score, their rank shifted left by 
+# SCORE_TIEBREAK_BITS with the low bits of their id as a tie-breaker.
+SCORE_TIEBREAK_BITS = 31
+
+# The top LEADERBOARD_SIZE quotes by score are kept in memcache 
+# for serving the first page of popular quotes.
+LEADERBOARD_KEY = "leaderboard|score"
+LEADERBOARD_SIZE = 2 * PAGE_SIZE
+LEADERBOARD_TTL = 600
+LEADERBOARD_RETRIES = 5
+
+# Pages of the popular and recent lists read by get_list() are kept in 
+# memcache for LIST_CACHE_TTL seconds, but are stale once their section 
+# changes or LIST_SOFT_TTL seconds after they were read. A stale page is
+# still served while a task reads it again, one task at a time per page,
+# or one per LIST_SOFT_TTL if the tasks are lost.
+LIST_SOFT_TTL = 60
+LIST_CACHE_TTL = 86400
+LIST_CACHE_PREFIX = "list|"
+LIST_REFRESH_PREFIX = "list-refresh|"
+
+# Number of QuoteVoteShard entities each new quote counts its votes in.
+# Zero keeps the vote count on the Quote entity itself, which is fine 
+# until a quote gets more than about one vote per second.
+VOTE_SHARDS = 0
+
+# Minimum number of seconds between folding the shards of a quote 
+# back into its votesum and score.
+ROLLUP_INTERVAL = 10
+
+# When True, VoteHandler queues votes with enqueue_vote() and answers
+# straight away, and drain_votes() applies them VOTE_BATCH_SIZE at a time.
+VOTE_WRITE_BEHIND = False
+VOTE_BATCH_SIZE = 100
+
+# The most entity groups a cross-group transaction may write to.
+MAX_XG_GROUPS = 25
+
+# A quote whose vote transactions are retried more than CONTENTION_THRESHOLD
+# times in the current and previous CONTENTION_WINDOW seconds is promoted
+# to hot, and votes on it are queued for drain_votes() to apply in batches.
+# It is demoted when a drain finds fewer than HOT_QUEUED_VOTES votes for it
+# and no contention in those windows, or after HOT_TTL seconds regardless.
+CONTENTION_WINDOW = 60
+CONTENTION_THRESHOLD = 5
+HOT_QUEUED_VOTES = 10
+HOT_TTL = 3600
+CONTENTION_PREFIX = "contention|"
+
+# The posting list of each search token is split over SEARCH_SHARDS
+# SearchIndexShard entities by quote id, each keeping the newest 
+# SEARCH_POSTING_LIMIT ids. At most SEARCH_MAX_TERMS words of a query 
+# are used, and the SEARCH_MAX_CANDIDATES newest matches are ranked, 
+# which bounds the work done by a search however many quotes there are.
+SEARCH_SHARDS = 8
+SEARCH_POSTING_LIMIT = 1000
+SEARCH_MAX_TERMS = 5
+SEARCH_MAX_CANDIDATES = 200
+SEARCH_CACHE_TTL = 60
+SEARCH_GENERATION_KEY = "search|generation"
+SEARCH_STOP_WORDS = frozenset(
+    'a an and are as at be but by for i if in is it of on or so that the '
+    'this to was we with you'.split())
+
+# Each user's lists of the quotes they added and voted on are kept in a 
+# UserIndex, the oldest ids moved out USER_INDEX_SHARD_SIZE at a time 
+# into UserIndexShards. Must be at least PAGE_SIZE.
+USER_INDEX_SHARD_SIZE = 200
+
+# When True, add_quote() also treats a quote as a duplicate if it shares
+# DUPLICATE_SHINGLE_MATCHES of the DUPLICATE_SKETCH_SIZE lowest hashes 
+# of its runs of DUPLICATE_SHINGLE_WORDS words with an existing quote.
+DUPLICATE_SHINGLES = False
+DUPLICATE_SHINGLE_WORDS = 3
+DUPLICATE_SKETCH_SIZE = 4
+DUPLICATE_SHINGLE_MATCHES = 2
+
+# A fingerprint is claimed before its quote is stored, so one whose quote
+# can't be found is only taken over once it is DUPLICATE_CLAIM_GRACE 
+# seconds old, and the quote is surely not on its way.
+DUPLICATE_CLAIM_GRACE = 60
+
+# Quotes read by id are cached encoded in memcache for QUOTE_CACHE_TTL 
+# seconds, and each instance keeps the QUOTE_CACHE_SIZE it used most 
+# recently for up to QUOTE_LOCAL_TTL seconds in front of that. A write 
+# deletes the quote from memcache and the cache of the instance making it,
+# and for QUOTE_CACHE_LOCK seconds reads can't add it back, so a read 
+# that started before the write can't store the old version. Other 
+# instances may serve a quote up to QUOTE_LOCAL_TTL seconds out of date.
+QUOTE_CACHE_PREFIX = "quote|"
+QUOTE_CACHE_TTL = 3600
+QUOTE_CACHE_SIZE = 1000
+QUOTE_LOCAL_TTL = 10
+QUOTE_CACHE_LOCK = 2
+
+# The clock used to timestamp new quotes, tests replace it so they don't
+# have to sleep to get distinct creation orders.
+_now = datetime.datetime.now
 
 
 class Quote(db.Model):
@@ -36,19 +144,42 @@ class Quote(db.Model):
   Properties
     quote:          The quote as a string
     uri:            An optional URI that is the source of the quotation
-    rank:           A calculated ranking based on the number of votes and when the quote was added.
+    rank:           No longer used. Was the ranking as a zero padded string, replaced 
+                      by score and cleared by RerankMapper.
+    score:          A calculated ranking based on the number of votes and when the quote 
+                      was added, unique to the quote. See _score().
     created:        When the quote was created, recorded in the number of days since the beginning of our local epoch.
     creation_order: Totally unique index on all quotes in order of their creation.
     creator:        The user that added this quote.
+    shards:         The number of QuoteVoteShards the votes are counted in, 
+                      or 0 if votesum is updated directly by each vote.
   """
   quote = db.StringProperty(required=True, multiline=True)
   uri   = db.StringProperty()
   rank = db.StringProperty()
+  score = db.IntegerProperty()
   created = db.IntegerProperty(default=0)
   creation_order = db.StringProperty(default=" ")
   votesum = db.IntegerProperty(default=0)
   creator = db.UserProperty()
+  shards = db.IntegerProperty(default=0)
+  
+
+class QuoteVoteShard(db.Model):
+  """Storage for part of the vote count of a sharded quote.
+
+  Each voter is assigned to one shard of the quote by a hash of their 
+  email, and their Vote is stored as a child of that shard so that 
+  votes on a popular quote are spread over several entity groups.
+  
+  Index
+    key_name: The quote id and the shard number, separated by a '|'.
   
+  Properties
+    votesum: Sum of all the votes recorded in this shard.
+  """
+  votesum = db.IntegerProperty(default=0)
+
 
 class Vote(db.Model):
   """Storage for a single vote by a single user on a single quote.
@@ -56,7 +187,8 @@ class Vote(db.Model):
 
   Index
     key_name: The email address of the user that voted.
-    parent:   The quote this is a vote for.
+    parent:   The quote this is a vote for, or the users QuoteVoteShard 
+                if the quote is sharded.
   
   Properties
     vote: The value of 1 for like, -1 for dislike.
@@ -68,8 +200,8 @@ class Voter(db.Model):
   """Storage for metadata about each user
   
   Properties
-    count:          An integer that gets incremented with users addition of a quote. 
-                      Used to build a unique index for quote creation.
+    count:          No longer used. Was incremented with each quote the user added
+                      to build a unique index for quote creation.
     hasVoted:       Has this user ever voted on a quote.
     hasAddedQuote:  Has this user ever added a quote.
   """
@@ -78,6 +210,369 @@ class Voter(db.Model):
   hasAddedQuote = db.BooleanProperty(default=False)  
 
 
+class MapperState(db.Model):
+  """Checkpoint of a Mapper run, from which the run resumes.
+  
+  Index
+    key_name: The NAME of the mapper.
+  
+  Properties
+    run:        Number of runs started or resumed, keeps the task names 
+                  of each unique.
+    cursor:     Query cursor following the last batch completed.
+    batches:    Number of batches completed in this run.
+    processed:  Number of entities mapped in this run.
+    changed:    Number of entities written back in this run.
+    seconds:    Time spent mapping and writing in this run, not counting 
+                  the pauses between batches.
+    started:    When this run was started.
+    checkpoint: When the last batch was completed.
+    done:       Has every entity been visited.
+  """
+  run = db.IntegerProperty(default=0)
+  cursor = db.TextProperty()
+  batches = db.IntegerProperty(default=0)
+  processed = db.IntegerProperty(default=0)
+  changed = db.IntegerProperty(default=0)
+  seconds = db.FloatProperty(default=0.0)
+  started = db.DateTimeProperty()
+  checkpoint = db.DateTimeProperty()
+  done = db.BooleanProperty(default=False)
+
+  def rate(self):
+    """Returns the entities mapped per second of work."""
+    if not self.seconds:
+      return 0.0
+    return self.processed / self.seconds
+
+
+class QuoteFingerprint(db.Model):
+  """Storage for the id of the quote with a given normalized text, so that 
+  duplicates are found by key.
+  
+  Index
+    key_name: The md5 of the normalized words of the quote, or 'shingle|' 
+                and one of its shingle hashes when DUPLICATE_SHINGLES is on.
+  
+  Properties
+    quote_id: The id of the quote with the fingerprint.
+    claimed:  When the fingerprint was claimed, None for those claimed 
+                before this was recorded.
+  """
+  quote_id = db.IntegerProperty(required=True)
+  claimed = db.DateTimeProperty(auto_now_add=True)
+
+
+class UserIndex(db.Model):
+  """Storage for the newest part of one of a users lists of quotes.
+  
+  Ids are only ever appended, a deleted quote is skipped when the list 
+  is read. Once the tail holds USER_INDEX_SHARD_SIZE ids they are moved 
+  into a new UserIndexShard, so neither entity grows without limit.
+  
+  Index
+    key_name: The name of the list, 'quotes' or 'votes', and the email
+                of the user, separated by a '|'.
+  
+  Properties
+    shards: The number of UserIndexShard children, holding the oldest ids.
+    tail:   The ids added since the last shard was filled, oldest first.
+  """
+  shards = db.IntegerProperty(default=0)
+  tail = db.ListProperty(long, indexed=False)
+
+
+class UserIndexShard(db.Model):
+  """Storage for USER_INDEX_SHARD_SIZE ids of a users list of quotes, 
+  never changed once written.
+  
+  Index
+    key_name: The number of the shard, counting from 0 for the oldest.
+    parent:   The UserIndex of the list.
+  
+  Properties
+    ids: Ids of the quotes, oldest first.
+  """
+  ids = db.ListProperty(long, indexed=False)
+
+
+class SearchIndexShard(db.Model):
+  """Storage for part of the posting list of a single search token.
+  
+  Index
+    key_name: The token and the shard number, separated by a '|'. A quote
+                is in shard number id % SEARCH_SHARDS of each of its tokens.
+  
+  Properties
+    ids: Ids of the quotes in this shard that contain the token, ascending.
+  """
+  ids = db.ListProperty(long, indexed=False)
+
+
+def list_generation():
+  """
+  Returns the current generation number of the quote lists.
+
+  The number changes every time a quote is added, removed or
+  voted on, so it can be made part of a cache key for anything
+  rendered from get_quotes() or get_quotes_newest(). If memcache
+  has lost the counter it is restarted from the current time so
+  that it doesn't go back to a value that was used before.
+  """
+  return _generation(LIST_GENERATION_KEY)
+
+
+def _generation(key):
+  """Returns the generation counter kept in memcache under 'key'."""
+  generation = memcache.get(key)
+  if generation is None:
+    generation = int(time.time())
+    if not memcache.add(key, generation):
+      generation = memcache.get(key) or generation
+  return generation
+
+
+def _invalidate_lists():
+  """Move the quote lists on to a new generation."""
+  memcache.incr(LIST_GENERATION_KEY, initial_value=int(time.time()))
+
+
+def last_changed(section):
+  """
+  Returns when the quotes in a section, 'popular' or 'recent', last 
+  changed, in seconds since the epoch. If memcache has lost track 
+  the section is taken to have changed now.
+  """
+  key = "changed|" + section
+  changed = memcache.get(key)
+  if changed is None:
+    changed = time.time()
+    if not memcache.add(key, changed):
+      changed = memcache.get(key) or changed
+  return changed
+
+
+def _quote_updated(quote, removed=False, sections=('popular', 'recent')):
+  """
+  Bring the cached views of the quote lists up to date after 
+  'quote' has been added, voted on or, if 'removed', deleted.
+  Only the listed sections are marked as changed, a vote doesn't
+  change what the recent section shows.
+  """
+  _uncache_quotes([quote.key().id()])
+  _invalidate_lists()
+  memcache.set_multi(dict([(section, time.time()) for section in sections]), 
+                     key_prefix="changed|")
+  _update_leaderboard(quote, removed)
+
+
+def _encode_quote(quote):
+  """Serialize a Quote for storing in memcache."""
+  return db.model_to_protobuf(quote).Encode()
+
+
+def _decode_quote(data):
+  """Rebuild a Quote serialized by _encode_quote()."""
+  return db.model_from_protobuf(entity_pb.EntityProto(data))
+
+
+class _LruCache(object):
+  """
+  A dictionary of at most 'size' entries, each expiring 'ttl' seconds 
+  after it was set, that drops the least recently used entry when full.
+
+  The entries are links [previous, next, key, value, expires] in a 
+  circular list with the most recently used next to the root, since
+  collections.OrderedDict needs Python 2.7.
+  """
+
+  def __init__(self, size, ttl):
+    self.size = size
+    self.ttl = ttl
+    self.lock = threading.Lock()
+    self.clear()
+
+  def clear(self):
+    """Drop every entry."""
+    self.lock.acquire()
+    try:
+      root = []
+      root[:] = [root, root, None, None, 0]
+      self.root = root
+      self.links = {}
+    finally:
+      self.lock.release()
+
+  def _unlink(self, link):
+    link[0][1] = link[1]
+    link[1][0] = link[0]
+
+  def _push(self, link):
+    root = self.root
+    link[0] = root
+    link[1] = root[1]
+    root[1][0] = link
+    root[1] = link
+
+  def get(self, key):
+    """Returns the value for 'key', or None if it is missing or expired."""
+    self.lock.acquire()
+    try:
+      link = self.links.get(key)
+      if link is None:
+        return None
+      self._unlink(link)
+      if link[4] < time.time():
+        del self.links[key]
+        return None
+      self._push(link)
+      return link[3]
+    finally:
+      self.lock.release()
+
+  def set(self, key, value):
+    """Store 'value' for 'key' as the most recently used entry."""
+    if self.size <= 0:
+      return
+    self.lock.acquire()
+    try:
+      link = self.links.pop(key, None)
+      if link is not None:
+        self._unlink(link)
+      elif len(self.links) >= self.size:
+        oldest = self.root[0]
+        self._unlink(oldest)
+        del self.links[oldest[2]]
+      link = [None, None, key, value, time.time() + self.ttl]
+      self._push(link)
+      self.links[key] = link
+    finally:
+      self.lock.release()
+
+  def delete(self, key):
+    """Drop the entry for 'key', if there is one."""
+    self.lock.acquire()
+    try:
+      link = self.links.pop(key, None)
+      if link is not None:
+        self._unlink(link)
+    finally:
+      self.lock.release()
+
+
+# This instance's cache of encoded quotes by id.
+_quote_cache = _LruCache(QUOTE_CACHE_SIZE, QUOTE_LOCAL_TTL)
+
+
+def _uncache_quotes(quote_ids):
+  """
+  Drop quotes that have been written or removed from the quote caches,
+  for the next read to fetch them again. Setting the new versions instead
+  could leave memcache holding an older one, when writes from two 
+  instances set it in the opposite order to their transactions.
+  """
+  for quote_id in quote_ids:
+    _quote_cache.delete(quote_id)
+  memcache.delete_multi([str(quote_id) for quote_id in quote_ids], 
+                        seconds=QUOTE_CACHE_LOCK, key_prefix=QUOTE_CACHE_PREFIX)
+
+
+def _get_leaderboard():
+  """
+  Returns the quotes at the top of the score order, at least PAGE_SIZE + 1
+  of them if there are that many, served from memcache when possible.
+
+  The cached leaderboard is a dictionary with 'entries', a list of 
+  (id, score, encoded quote) in score order, and 'complete', which is 
+  True when the entries are every quote there is. It is kept up to date 
+  by _update_leaderboard() and only rebuilt from the score index when 
+  it is missing or has lost too many entries.
+  """
+  board = memcache.get(LEADERBOARD_KEY)
+  if board is not None and (board['complete'] or len(board['entries']) > PAGE_SIZE):
+    return [_decode_quote(data) for (id, score, data) in board['entries'][:PAGE_SIZE + 1]]
+  quotes = Quote.gql('ORDER BY score DESC').fetch(LEADERBOARD_SIZE)
+  memcache.set(LEADERBOARD_KEY, {
+      'complete': len(quotes) < LEADERBOARD_SIZE,
+      'entries': [(q.key().id(), q.score, _encode_quote(q)) for q in quotes]
+    }, time=LEADERBOARD_TTL)
+  return quotes[:PAGE_SIZE + 1]
+
+
+def _update_leaderboard(quote, removed=False):
+  """
+  Move, add or remove a quote in the cached leaderboard using 
+  compare-and-set, so concurrent updates are not lost.
+
+  A quote outside the leaderboard is only added if it ranks at least as
+  high as the lowest entry, since anything below that might be beaten by 
+  quotes that aren't in the leaderboard. For the same reason a quote that 
+  falls below the lowest entry is dropped. If the leaderboard can't be 
+  updated it is deleted, to be rebuilt on the next read.
+
+  The quote is read again after each gets. The writer's own copy could 
+  be older than one another writer already stored, when two votes on 
+  the quote finish in the opposite order to their transactions, but a 
+  read made after the gets is at least as new as anything in the board, 
+  and if the board changes before the cas the cas fails and it is read 
+  again.
+  """
+  client = memcache.Client()
+  quote_id = quote.key().id()
+  for i in range(LEADERBOARD_RETRIES):
+    board = client.gets(LEADERBOARD_KEY)
+    if board is None:
+      return
+    if not removed:
+      quote = Quote.get_by_id(quote_id)
+      removed = quote is None
+    complete = board['complete']
+    entries = [entry for entry in board['entries'] if entry[0] != quote_id]
+    if not removed and (complete or (entries and quote.score >= entries[-1][1])):
+      entries.append((quote_id, quote.score, _encode_quote(quote)))
+      entries.sort(key=lambda entry: entry[1], reverse=True)
+      if len(entries) > LEADERBOARD_SIZE:
+        entries = entries[:LEADERBOARD_SIZE]
+        complete = False
+    board = {'complete': complete, 'entries': entries}
+    if client.cas(LEADERBOARD_KEY, board, time=LEADERBOARD_TTL):
+      return
+  memcache.delete(LEADERBOARD_KEY)
+
+
+def _shard_key(quote_id, shard):
+  """Returns the key of one of the QuoteVoteShards of a quote."""
+  return db.Key.from_path('QuoteVoteShard', '%d|%d' % (quote_id, shard))
+
+
+def _vote_key(quote, email):
+  """Returns the key of the Vote by 'email' on 'quote'."""
+  if quote.shards:
+    shard = int(hashlib.md5(email).hexdigest()[:8], 16) % quote.shards
+    parent = _shard_key(quote.key().id(), shard)
+  else:
+    parent = quote.key()
+  return db.Key.from_path('Vote', email, parent=parent)
+
+
+def _score(quote):
+  """
+  Returns the score of a quote from its creation day, votesum and id.
+
+  The rank is shifted up to make room for the low SCORE_TIEBREAK_BITS 
+  bits of the quote id, which are unique as long as ids are allocated 
+  sequentially, as add_quote() does, and there are fewer than 2**31 quotes. 
+  The result fits comfortably in a 64-bit IntegerProperty, and quotes of 
+  equal rank sort newest first. Older quotes with automatically assigned 
+  ids, which are scattered, have their ties broken in no particular order.
+  """
+  # See the docstring of main.py for an explanation of
+  # the following formula.
+  rank = long(quote.created * DAY_SCALE + quote.votesum)
+  tiebreak = quote.key().id() & ((1 << SCORE_TIEBREAK_BITS) - 1)
+  return (rank << SCORE_TIEBREAK_BITS) + tiebreak
+
+
 def _get_or_create_voter(user):
   """
   Find a matching Voter or create a new one with the
@@ -91,45 +586,62 @@ def _get_or_create_voter(user):
   return voter
 
 
+def _progress_cache_key(user):
+  """Returns the memcache key holding the progress of a user."""
+  return "progress|" + user.email()
+
+
 def get_progress(user):
   """
   Returns (hasVoted, hasAddedQuote) for the given user
   """
-  voter = _get_or_create_voter(user)
-  return voter.hasVoted, voter.hasAddedQuote
+  key = _progress_cache_key(user)
+  progress = memcache.get(key)
+  if progress is None:
+    voter = _get_or_create_voter(user)
+    progress = (voter.hasVoted, voter.hasAddedQuote)
+    memcache.set(key, progress)
+  return progress
   
 
-def _set_progress_hasVoted(user):
+def _set_progress(user, flag):
   """
-  Sets Voter.hasVoted = True for the given user.
+  Sets the Voter property 'flag', either 'hasVoted' or 'hasAddedQuote', 
+  to True for the given user. Once the flag is set this only costs 
+  a memcache lookup.
   """
+  if get_progress(user)[['hasVoted', 'hasAddedQuote'].index(flag)]:
+    return
 
   def txn():
     voter = _get_or_create_voter(user)
-    if not voter.hasVoted:
-      voter.hasVoted = True
+    if not getattr(voter, flag):
+      setattr(voter, flag, True)
       voter.put()
+    return voter
       
-  db.run_in_transaction(txn)
+  voter = db.run_in_transaction(txn)
+  memcache.set(_progress_cache_key(user), (voter.hasVoted, voter.hasAddedQuote))
 
 
-def _unique_user(user):
+def _set_progress_hasVoted(user):
   """
-  Creates a unique string by using an increasing
-  counter sharded per user. The resulting string
-  is hashed to keep the users email address private.
+  Sets Voter.hasVoted = True for the given user.
   """
-  
-  def txn():
-    voter = _get_or_create_voter(user)
-    voter.count += 1
-    voter.hasAddedQuote = True
-    voter.put()
-    return voter.count
+  _set_progress(user, 'hasVoted')
+
 
-  count = db.run_in_transaction(txn)
+def _unique_user(user):
+  """
+  Creates a unique string from the users email and a
+  random UUID. The resulting string is hashed to keep 
+  the users email address private.
 
-  return hashlib.md5(user.email() + "|" + str(count)).hexdigest()
+  Unlike a counter kept per user this needs no datastore 
+  access, so a user adding many quotes isn't held up 
+  waiting on their own Voter entity.
+  """
+  return hashlib.md5(user.email() + "|" + uuid.uuid4().hex).hexdigest()
   
 
 def add_quote(text, user, uri=None, _created=None):
@@ -144,27 +656,53 @@ def add_quote(text, user, uri=None, _created=None):
                 value, used only for testing.
   
   Returns  
-    The id of the quote or None if the add failed.
+    The id of the quote, or of the existing quote it duplicates, or None 
+    if the add failed.
+  """
+  return add_or_find_quote(text, user, uri, _created)[0]
+
+
+def add_or_find_quote(text, user, uri=None, _created=None):
+  """
+  Add a new quote to the datastore, as add_quote() does.
+
+  Returns
+    (quote_id, added), where added is False if quote_id is the existing 
+    quote the text duplicates. quote_id is None if the add failed.
   """
   try:
-    now = datetime.datetime.now()
+    now = _now()
     unique_user = _unique_user(user)
     if _created:
       created = _created
     else:
       created = (now - datetime.datetime(2008, 10, 1)).days
       
+    # Allocate the id first, the score and fingerprint depend on it.
+    first, last = db.allocate_ids(db.Key.from_path('Quote', 1), 1)
+    duplicate = _claim_fingerprint(text, first)
+    if duplicate is not None:
+      return duplicate, False
     q = Quote(
+      key=db.Key.from_path('Quote', first),
       quote=text, 
       created=created, 
       creator=user, 
       creation_order = now.isoformat()[:19] + "|" + unique_user,
-      uri=uri
+      uri=uri,
+      shards=VOTE_SHARDS
     )
+    q.score = _score(q)
     q.put()
-    return q.key().id()
+    _quote_updated(q)
+    _index_quote(q)
+    if DUPLICATE_SHINGLES:
+      _claim_shingles(text, first)
+    _append_user_index('quotes', user.email(), [first])
+    _set_progress(user, 'hasAddedQuote')
+    return q.key().id(), True
   except db.Error:
-    return None 
+    return None, False
   
 def del_quote(quote_id, user):
   """
@@ -172,16 +710,68 @@ def del_quote(quote_id, user):
   
   User must be the creator of the quote or a site administrator.
   """
-  q = Quote.get_by_id(quote_id)
+  q = get_quote(quote_id)
   if q is not None and (users.is_current_user_admin() or q.creator == user):
     q.delete()
+    _quote_updated(q, removed=True)
+    _index_quote(q, removed=True)
+    _release_fingerprints(q)
 
 
 def get_quote(quote_id):
   """
-  Retrieve a single quote.
+  Retrieve a single quote, see get_quotes_by_ids().
+  """
+  return get_quotes_by_ids([quote_id])[0]
+
+
+def get_quotes_by_ids(quote_ids):
+  """
+  Retrieve several quotes in one batch. Returns a list in the 
+  same order as 'quote_ids', with None for any missing quote.
+
+  Quotes are looked for in this instance's cache, then in memcache, and
+  only the rest are read from the datastore, in a single batch get. The
+  quotes may be a few seconds out of date, so don't read a quote this 
+  way inside a transaction that writes it.
   """
-  return Quote.get_by_id(quote_id)
+  quote_ids = list(quote_ids)
+  found = {}
+  missing = []
+  for quote_id in quote_ids:
+    data = _quote_cache.get(quote_id)
+    if data is None:
+      missing.append(quote_id)
+    else:
+      found[quote_id] = data
+  if missing:
+    cached = memcache.get_multi([str(quote_id) for quote_id in missing], 
+                                key_prefix=QUOTE_CACHE_PREFIX)
+    stored = []
+    for quote_id in missing:
+      data = cached.get(str(quote_id))
+      if data is None:
+        stored.append(quote_id)
+      else:
+        found[quote_id] = data
+        _quote_cache.set(quote_id, data)
+    if stored:
+      encoded = {}
+      for quote in Quote.get_by_id(stored):
+        if quote is not None:
+          quote_id = quote.key().id()
+          found[quote_id] = encoded[str(quote_id)] = _encode_quote(quote)
+          _quote_cache.set(quote_id, found[quote_id])
+      if encoded:
+        memcache.add_multi(encoded, key_prefix=QUOTE_CACHE_PREFIX, time=QUOTE_CACHE_TTL)
+  quotes = []
+  for quote_id in quote_ids:
+    data = found.get(quote_id)
+    if data is None:
+      quotes.append(None)
+    else:
+      quotes.append(_decode_quote(data))
+  return quotes
 
 
 def get_quotes_newest(offset=None):
@@ -215,54 +805,1075 @@ def set_vote(quote_id, user, newvote):
   """
   if user is None:
     return
-  email = user.email()
-  
+  if _hot_quotes([quote_id]):
+    enqueue_vote(quote_id, user, newvote)
+    return
+  quote = get_quote(quote_id)
+  if quote is None:
+    return
+  _apply_votes(quote, {user.email(): newvote})
+  _set_progress_hasVoted(user)
+
+
+def _vote_cache_key(email, quote_id):
+  """Returns the memcache key holding the vote by 'email' on a quote."""
+  return "vote|" + email + "|" + str(quote_id)
+
+
+def _apply_votes(quote, votes, cache=True):
+  """
+  Record the votes of one or more users on a single quote. 
+
+  Args
+    quote:  The Quote being voted on.
+    votes:  A dictionary mapping the email of each voter to their new vote.
+    cache:  Update the cached value of each vote that changed.
+
+  Returns
+    True if any of the votes changed.
+  """
+  quote_id = quote.key().id()
+  if quote.shards:
+    changed = False
+    for email, newvote in votes.items():
+      changed = _set_vote_sharded(quote, email, newvote, cache) or changed
+    return changed
+  emails = votes.keys()
+
   def txn():
     quote = Quote.get_by_id(quote_id)
-    vote = Vote.get_by_key_name(key_names = user.email(), parent = quote)
+    if quote is None:
+      return [], [], None
+    changed = []
+    first = []
+    existing = Vote.get([_vote_key(quote, email) for email in emails])
+    for email, vote in zip(emails, existing):
+      if vote is None:
+        vote = Vote(key_name = email, parent = quote)
+      if vote.vote == votes[email]:
+        continue
+      if not vote.is_saved():
+        first.append(email)
+      quote.votesum = quote.votesum - vote.vote + votes[email]
+      vote.vote = votes[email]
+      changed.append(vote)
+    if changed:
+      quote.score = _score(quote)
+      db.put(changed + [quote])
+    return changed, first, quote
+
+  changed, first, quote = _run_in_transaction([quote_id], txn)
+  if not changed:
+    return False
+  for email in first:
+    _append_user_index('votes', email, [quote_id])
+  if cache:
+    memcache.set_multi(dict([(_vote_cache_key(vote.key().name(), quote_id), vote.vote) 
+                             for vote in changed]))
+  _quote_updated(quote, sections=('popular',))
+  return True
+
+
+def _set_vote_sharded(quote, email, newvote, cache=True):
+  """
+  Record a vote on a sharded quote. The vote and the change in 
+  votesum are written to the voters shard only, the quote itself
+  is brought up to date later by rollup_votes().
+
+  Returns True if the vote changed.
+  """
+  quote_id = quote.key().id()
+  vote_key = _vote_key(quote, email)
+  shard_key = vote_key.parent()
+
+  def txn():
+    vote = Vote.get(vote_key)
     if vote is None:
-      vote = Vote(key_name = user.email(), parent = quote)
+      vote = Vote(key_name = email, parent = shard_key)
     if vote.vote == newvote:
-      return 
-    quote.votesum = quote.votesum - vote.vote + newvote
+      return None
+    first = not vote.is_saved()
+    shard = QuoteVoteShard.get(shard_key)
+    if shard is None:
+      shard = QuoteVoteShard(key = shard_key)
+    shard.votesum = shard.votesum - vote.vote + newvote
     vote.vote = newvote
-    # See the docstring of main.py for an explanation of
-    # the following formula.
-    quote.rank = "%020d|%s" % (
-      long(quote.created * DAY_SCALE + quote.votesum), 
-      quote.creation_order
-      )
-    db.put([vote, quote])
-    memcache.set("vote|" + user.email() + "|" + str(quote_id), vote.vote)
-
-  db.run_in_transaction(txn)
-  _set_progress_hasVoted(user)
+    db.put([vote, shard])
+    return first
+
+  first = _run_in_transaction([quote_id], txn)
+  if first is None:
+    return False
+  if first:
+    _append_user_index('votes', email, [quote_id])
+  if cache:
+    memcache.set(_vote_cache_key(email, quote_id), newvote)
+  _schedule_rollup(quote_id)
+  return True
 
+
+def set_votes(user, votes):
+  """
+  Record several votes by 'user' at once. 
+
+  Votes on unsharded quotes are applied in cross-group transactions
+  of up to MAX_XG_GROUPS quotes, so a whole page of votes takes one
+  batch get of the quotes and their votes, and one batch put.
+
+  Args
+    user:   The user voting.
+    votes:  A list of (quote_id, newvote) pairs. If a quote appears 
+              more than once the last vote for it wins.
+
+  Returns
+    A list with a result for each vote, 'ok' if the vote was recorded, 
+    'queued' if it will be recorded by drain_votes() because the quote
+    is hot, 'unchanged' if the user had already voted that way, 
+    'not_found' if there is no such quote, or 'failed' if the transaction
+    recording it failed, in which case none of the votes that shared 
+    that transaction were recorded either.
+  """
+  if user is None:
+    return []
+  email = user.email()
+  latest = dict(votes)
+  results = {}
+  found = set()
+  unsharded = []
+  hot = _hot_quotes(latest.keys())
+  for quote_id in hot:
+    enqueue_vote(quote_id, user, latest.pop(quote_id))
+    results[quote_id] = 'queued'
+  for quote in get_quotes_by_ids(latest.keys()):
+    if quote is None:
+      continue
+    quote_id = quote.key().id()
+    found.add(quote_id)
+    if quote.shards:
+      try:
+        if _set_vote_sharded(quote, email, latest[quote_id]):
+          results[quote_id] = 'ok'
+      except db.TransactionFailedError:
+        results[quote_id] = 'failed'
+    else:
+      unsharded.append(quote_id)
   
-def get_quotes(page=0):
-  """Returns PAGE_SIZE quotes per page in rank order. Limit to 20 pages."""
-  assert page >= 0
-  assert page < 20
+  def txn(ids):
+    quotes = [quote for quote in Quote.get_by_id(ids) if quote is not None]
+    existing = Vote.get([_vote_key(quote, email) for quote in quotes])
+    changed = []
+    first = []
+    for quote, vote in zip(quotes, existing):
+      newvote = latest[quote.key().id()]
+      if vote is None:
+        vote = Vote(key_name = email, parent = quote)
+      if vote.vote == newvote:
+        continue
+      if not vote.is_saved():
+        first.append(quote.key().id())
+      quote.votesum = quote.votesum - vote.vote + newvote
+      quote.score = _score(quote)
+      vote.vote = newvote
+      changed.append(quote)
+      changed.append(vote)
+    db.put(changed)
+    return changed[::2], first
+
+  options = db.create_transaction_options(xg=True)
+  for i in range(0, len(unsharded), MAX_XG_GROUPS):
+    ids = unsharded[i:i + MAX_XG_GROUPS]
+    try:
+      changed, first = _run_in_transaction(ids, txn, ids, options=options)
+    except db.TransactionFailedError:
+      logging.warning('Failed to record votes by %s on %s', email, ids)
+      for quote_id in ids:
+        results[quote_id] = 'failed'
+      continue
+    if first:
+      _append_user_index('votes', email, first)
+    memcache.set_multi(dict([(_vote_cache_key(email, quote.key().id()), 
+                              latest[quote.key().id()]) for quote in changed]))
+    for quote in changed:
+      _quote_updated(quote, sections=('popular',))
+      results[quote.key().id()] = 'ok'
+
+  if [result for result in results.values() if result == 'ok']:
+    _set_progress_hasVoted(user)
+  return [results.get(quote_id, quote_id in found and 'unchanged' or 'not_found') 
+          for (quote_id, newvote) in votes]
+
+
+class LocalVoteQueue(object):
+  """
+  Holds queued votes in memory. Only useful for tests and the 
+  development server, since each instance gets its own queue.
+  """
+
+  def __init__(self):
+    self.payloads = []
+
+  def add(self, payload):
+    """Add a vote to the end of the queue."""
+    self.payloads.append(payload)
+
+  def lease(self, max_items):
+    """Take up to max_items votes, returns a list of (handle, payload)."""
+    leased = self.payloads[:max_items]
+    del self.payloads[:max_items]
+    return [(None, payload) for payload in leased]
+
+  def delete(self, handles):
+    """Forget votes that have been applied, nothing to do here."""
+    pass
+
+
+class TaskVoteQueue(object):
+  """Holds queued votes in a pull queue, see queue.yaml."""
+
+  LEASE_SECONDS = 60
+
+  def __init__(self, name='votes'):
+    self.queue = taskqueue.Queue(name)
+
+  def add(self, payload):
+    """Add a vote to the queue."""
+    self.queue.add(taskqueue.Task(payload=payload, method='PULL'))
+
+  def lease(self, max_items):
+    """Lease up to max_items votes, returns a list of (handle, payload)."""
+    tasks = self.queue.lease_tasks(self.LEASE_SECONDS, max_items)
+    return [(task, task.payload) for task in tasks]
+
+  def delete(self, handles):
+    """Remove votes that have been applied from the queue."""
+    if handles:
+      self.queue.delete_tasks(handles)
+
+
+# Where enqueue_vote() puts votes for drain_votes() to apply.
+vote_queue = TaskVoteQueue()
+
+
+def enqueue_vote(quote_id, user, newvote):
+  """
+  Queue 'user' casting a vote on a quote, to be recorded later by 
+  drain_votes(). The vote is written to memcache straight away so 
+  that voted() returns the new value for the user before then.
+  """
+  if user is None:
+    return
+  email = user.email()
+  memcache.set(_vote_cache_key(email, quote_id), newvote)
+  vote_queue.add('%.6f|%d|%d|%s' % (time.time(), quote_id, newvote, email))
+
+
+def drain_votes(max_items=VOTE_BATCH_SIZE, queued=None):
+  """
+  Apply a batch of votes from the vote queue. 
+
+  Only the latest vote of each user on each quote is kept, and all the 
+  votes on a quote are then applied in a single transaction, so a quote 
+  getting many votes has its votesum and score written once per batch.
+
+  Args
+    max_items:  The most votes to take from the queue.
+    queued:     If given, a dictionary in which to add up the number of 
+                  votes taken for each quote id, for cool_hot_quotes().
+
+  Returns
+    The number of queued votes that were taken from the queue.
+  """
+  leased = vote_queue.lease(max_items)
+  if not leased:
+    return 0
+  latest = {}
+  if queued is None:
+    queued = {}
+  for handle, payload in leased:
+    stamp, quote_id, newvote, email = payload.split('|', 3)
+    queued[long(quote_id)] = queued.get(long(quote_id), 0) + 1
+    votes = latest.setdefault(long(quote_id), {})
+    if email not in votes or votes[email][0] <= float(stamp):
+      votes[email] = (float(stamp), int(newvote))
+  voters = {}
+  for quote in get_quotes_by_ids(latest.keys()):
+    if quote is None:
+      continue
+    votes = latest[quote.key().id()]
+    _apply_votes(quote, dict([(email, vote) for (email, (stamp, vote)) in votes.items()]), 
+                 cache=False)
+    voters.update(votes)
+  for email in voters:
+    _set_progress_hasVoted(users.User(email))
+  vote_queue.delete([handle for handle, payload in leased])
+  return len(leased)
+
+
+def _run_in_transaction(quote_ids, function, *args, **kwargs):
+  """
+  Run 'function' in a transaction, like db.run_in_transaction_options() 
+  with the given 'options', recording the retries made, or all the 
+  attempts if the transaction failed, as contention on the quote.
+
+  Only a transaction on a single quote is recorded. A cross-group
+  transaction can't tell which of its quotes collided, and charging 
+  them all would make hot quotes of ones that never contended.
+  """
+  if len(quote_ids) != 1:
+    quote_ids = []
+  options = kwargs.get('options') or db.create_transaction_options()
+  attempts = [0]
+
+  def txn(*args):
+    attempts[0] += 1
+    return function(*args)
+
+  try:
+    result = db.run_in_transaction_options(options, txn, *args)
+  except db.TransactionFailedError:
+    if quote_ids:
+      _record_contention(quote_ids, attempts[0])
+    raise
+  if quote_ids and attempts[0] > 1:
+    _record_contention(quote_ids, attempts[0] - 1)
+  return result
+
+
+def _contention_keys(quote_id):
+  """Returns the memcache keys counting contention on a quote in the 
+  current and the previous window."""
+  window = int(time.time() / CONTENTION_WINDOW)
+  return ['%d|%d' % (quote_id, window), '%d|%d' % (quote_id, window - 1)]
+
+
+def _record_contention(quote_ids, count):
+  """Add 'count' collisions to each quote, promoting those over the threshold."""
+  keys = dict([(quote_id, _contention_keys(quote_id)) for quote_id in quote_ids])
+  current = memcache.offset_multi(dict([(keys[quote_id][0], count) for quote_id in quote_ids]), 
+                                  key_prefix=CONTENTION_PREFIX, initial_value=0)
+  previous = memcache.get_multi([keys[quote_id][1] for quote_id in quote_ids], 
+                                key_prefix=CONTENTION_PREFIX)
+  for quote_id in quote_ids:
+    total = (current.get(keys[quote_id][0]) or 0) + previous.get(keys[quote_id][1], 0)
+    if total > CONTENTION_THRESHOLD:
+      _promote(quote_id)
+
+
+def _hot_quotes(quote_ids):
+  """Returns the ids of those of the quotes that are hot."""
+  hot = memcache.get_multi(['hot|%d' % quote_id for quote_id in quote_ids], 
+                           key_prefix=CONTENTION_PREFIX)
+  return [quote_id for quote_id in quote_ids if 'hot|%d' % quote_id in hot]
+
+
+def hot_quote_ids():
+  """Returns the ids of the quotes that have been promoted to hot."""
+  return memcache.get(CONTENTION_PREFIX + 'hot') or []
+
+
+def _promote(quote_id):
+  """Send the votes on a quote through the vote queue from now on."""
+  if not memcache.add(CONTENTION_PREFIX + 'hot|%d' % quote_id, 1, time=HOT_TTL):
+    return
+  logging.info('Quote %d is hot, queueing its votes' % quote_id)
+  memcache.incr(CONTENTION_PREFIX + 'promotions', initial_value=0)
+  hot = hot_quote_ids()
+  memcache.set(CONTENTION_PREFIX + 'hot', [id for id in hot if id != quote_id] + [quote_id])
+
+
+def _demote(quote_id):
+  """Record the votes on a quote directly again."""
+  memcache.delete(CONTENTION_PREFIX + 'hot|%d' % quote_id)
+  logging.info('Quote %d has cooled, recording its votes directly' % quote_id)
+  memcache.incr(CONTENTION_PREFIX + 'demotions', initial_value=0)
+  memcache.set(CONTENTION_PREFIX + 'hot', [id for id in hot_quote_ids() if id != quote_id])
+
+
+def cool_hot_quotes(queued):
+  """
+  Demote the hot quotes that had fewer than HOT_QUEUED_VOTES of the 
+  votes just drained, as counted in 'queued' by drain_votes(), and no 
+  recent contention. Quotes that expired from hot after HOT_TTL are 
+  dropped from the list too.
+  """
+  hot = hot_quote_ids()
+  if not hot:
+    return
+  keys = []
+  for quote_id in hot:
+    keys.extend(_contention_keys(quote_id) + ['hot|%d' % quote_id])
+  values = memcache.get_multi(keys, key_prefix=CONTENTION_PREFIX)
+  for quote_id in hot:
+    current, previous = _contention_keys(quote_id)
+    if 'hot|%d' % quote_id not in values:
+      _demote(quote_id)
+    elif (queued.get(quote_id, 0) < HOT_QUEUED_VOTES 
+          and not values.get(current) and not values.get(previous)):
+      _demote(quote_id)
+
+
+def contention_stats():
+  """Returns (promotions, demotions, ids of the hot quotes)."""
+  counts = memcache.get_multi(['promotions', 'demotions'], key_prefix=CONTENTION_PREFIX)
+  return counts.get('promotions', 0), counts.get('demotions', 0), hot_quote_ids()
+
+
+def _schedule_rollup(quote_id):
+  """
+  Arrange for rollup_votes() to run for a quote in ROLLUP_INTERVAL seconds.
+  At most one rollup is queued per quote per interval, the memcache 
+  check saves most votes from making a task queue call at all.
+  """
+  name = 'rollup-%d-%d' % (quote_id, int(time.time() / ROLLUP_INTERVAL))
+  if not memcache.add(name, 1, time=ROLLUP_INTERVAL):
+    return
+  try:
+    taskqueue.add(name=name, url='/_tasks/rollup', 
+        params={'id': quote_id}, countdown=ROLLUP_INTERVAL)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+
+def rollup_votes(quote_id):
+  """
+  Add up the QuoteVoteShards of a sharded quote and store
+  the total as its votesum, recalculating the score to match.
+  """
+  quote = get_quote(quote_id)
+  if quote is None or not quote.shards:
+    return
+  shards = QuoteVoteShard.get(
+      [_shard_key(quote_id, i) for i in range(quote.shards)])
+  votesum = sum([shard.votesum for shard in shards if shard is not None])
+
+  def txn():
+    quote = Quote.get_by_id(quote_id)
+    if quote is None or (quote.votesum == votesum and quote.score is not None):
+      return None
+    quote.votesum = votesum
+    quote.score = _score(quote)
+    quote.put()
+    return quote
+
+  quote = db.run_in_transaction(txn)
+  if quote is not None:
+    _quote_updated(quote, sections=('popular',))
+
+
+def _words(text):
+  """Returns the words of 'text', lower cased and without punctuation."""
+  return re.findall(r'\w+', text.lower(), re.UNICODE)
+
+
+def _search_tokens(text):
+  """Returns the set of normalized words in 'text' that are worth indexing."""
+  return set([word[:32] for word in _words(text)
+              if len(word) > 1 and word not in SEARCH_STOP_WORDS])
+
+
+def _fingerprint(text):
+  """Returns the fingerprint of a quote, the same whatever its case, 
+  whitespace or punctuation."""
+  return hashlib.md5(u' '.join(_words(text)).encode('utf-8')).hexdigest()
+
+
+def _shingle_keys(text):
+  """
+  Returns the QuoteFingerprint keys of the DUPLICATE_SKETCH_SIZE lowest 
+  hashes of the runs of DUPLICATE_SHINGLE_WORDS words in 'text'. Quotes 
+  differing by a word or two still share most of them.
+  """
+  words = _words(text)
+  size = DUPLICATE_SHINGLE_WORDS
+  hashes = set([hashlib.md5(u' '.join(words[i:i + size]).encode('utf-8')).hexdigest()[:12]
+                for i in range(len(words) - size + 1)])
+  return [db.Key.from_path('QuoteFingerprint', 'shingle|' + h) 
+          for h in sorted(hashes)[:DUPLICATE_SKETCH_SIZE]]
+
+
+def _claim_fingerprint(text, quote_id):
+  """
+  Record 'quote_id' as the quote with the fingerprint of 'text', unless 
+  an existing quote already has it or, when DUPLICATE_SHINGLES is on, 
+  shares enough of its shingles.
+
+  Returns
+    The id of the existing quote, or None if 'quote_id' may be stored.
+  """
+  fingerprint = _fingerprint(text)
+
+  def txn(stale):
+    entry = QuoteFingerprint.get_by_key_name(fingerprint)
+    if entry is not None and entry.quote_id not in (quote_id, stale):
+      return entry
+    QuoteFingerprint(key_name=fingerprint, quote_id=quote_id).put()
+    return None
+
+  duplicate = None
+  entry = db.run_in_transaction(txn, None)
+  if entry is not None:
+    duplicate = entry.quote_id
+    grace = _now() - datetime.timedelta(seconds=DUPLICATE_CLAIM_GRACE)
+    if (entry.claimed is None or entry.claimed < grace) and get_quote(duplicate) is None:
+      # Left behind by a quote whose add or delete didn't finish.
+      entry = db.run_in_transaction(txn, duplicate)
+      if entry is None:
+        duplicate = None
+      else:
+        duplicate = entry.quote_id
+  if duplicate is None and DUPLICATE_SHINGLES:
+    counts = {}
+    for entry in QuoteFingerprint.get(_shingle_keys(text)):
+      if entry is not None and entry.quote_id != quote_id:
+        counts[entry.quote_id] = counts.get(entry.quote_id, 0) + 1
+    for match, count in counts.items():
+      if count >= DUPLICATE_SHINGLE_MATCHES and get_quote(match) is not None:
+        db.delete(db.Key.from_path('QuoteFingerprint', fingerprint))
+        return match
+  return duplicate
+
+
+def _claim_shingles(text, quote_id):
+  """Record 'quote_id' against those of its shingle hashes no other quote has."""
+  keys = _shingle_keys(text)
+  db.put([QuoteFingerprint(key=key, quote_id=quote_id) 
+          for key, entry in zip(keys, QuoteFingerprint.get(keys)) if entry is None])
+
+
+def _release_fingerprints(quote):
+  """Remove the fingerprint and shingles of a deleted quote."""
+  quote_id = quote.key().id()
+  keys = [db.Key.from_path('QuoteFingerprint', _fingerprint(quote.quote))]
+  keys.extend(_shingle_keys(quote.quote))
+  db.delete([entry for entry in QuoteFingerprint.get(keys)
+             if entry is not None and entry.quote_id == quote_id])
+
+
+def _user_index_key(name, email):
+  """Returns the key of the UserIndex of one of a users lists of quotes."""
+  return db.Key.from_path('UserIndex', '%s|%s' % (name, email))
+
+
+def _append_user_index(name, email, quote_ids):
+  """
+  Append quote ids to one of a users lists, 'quotes' or 'votes', moving
+  full shards out of the tail. A failure is logged rather than raised, 
+  since the quote or vote being listed has already been stored.
+  """
+  key = _user_index_key(name, email)
+
+  def txn():
+    index = UserIndex.get(key)
+    if index is None:
+      index = UserIndex(key=key)
+    index.tail.extend(quote_ids)
+    entities = [index]
+    while len(index.tail) >= USER_INDEX_SHARD_SIZE:
+      entities.append(UserIndexShard(parent=key, key_name=str(index.shards), 
+                                     ids=index.tail[:USER_INDEX_SHARD_SIZE]))
+      index.tail = index.tail[USER_INDEX_SHARD_SIZE:]
+      index.shards += 1
+    db.put(entities)
+
+  try:
+    db.run_in_transaction(txn)
+  except db.Error, e:
+    logging.warning('%s list of %s not updated: %s' % (name, email, e))
+
+
+def get_user_quotes(user, name, cursor=None):
+  """
+  Returns PAGE_SIZE quotes per page from one of a users lists, the quotes
+  they added or voted on, the most recently listed first.
+
+  A page costs a get of the UserIndex, a get of at most two of its 
+  shards, and a get of the quotes, however long the list is.
+
+  Args
+    user:    The user whose list it is.
+    name:    The name of the list, 'quotes' or 'votes'.
+    cursor:  The position to end the page at. This is the value of 
+               'extra' returned from a previous call to this function.
+
+  Returns
+    (quotes, extra)
+  """
+  key = _user_index_key(name, user.email())
+  index = UserIndex.get(key)
+  if index is None:
+    return [], None
+  end = index.shards * USER_INDEX_SHARD_SIZE + len(index.tail)
+  if cursor is not None:
+    end = min(cursor, end)
+  start = max(end - PAGE_SIZE, 0)
+  if end <= start:
+    return [], None
+  first_shard = start / USER_INDEX_SHARD_SIZE
+  last_shard = min((end - 1) / USER_INDEX_SHARD_SIZE, index.shards - 1)
+  ids = []
+  if first_shard <= last_shard:
+    shards = UserIndexShard.get([db.Key.from_path('UserIndexShard', str(n), parent=key) 
+                                 for n in range(first_shard, last_shard + 1)])
+    for shard in shards:
+      ids.extend(shard.ids)
+  ids.extend(index.tail)
+  offset = first_shard * USER_INDEX_SHARD_SIZE
+  ids = ids[start - offset:end - offset]
+  ids.reverse()
+  extra = None
+  if start > 0:
+    extra = start
+  quotes = get_quotes_by_ids(ids)
+  return [quote for quote in quotes if quote is not None], extra
+
+
+def _search_key(token, shard):
+  """Returns the key of one of the SearchIndexShards of a token."""
+  return db.Key.from_path('SearchIndexShard', u'%s|%d' % (token, shard))
+
+
+def _index_quote(quote, removed=False):
+  """
+  Add a quote to, or remove it from, the posting list of each of its
+  tokens, in cross-group transactions of up to MAX_XG_GROUPS shards.
+  Both are idempotent. A failure is logged rather than raised, leaving
+  the quote unsearchable until SearchIndexMapper is run, since the 
+  quote itself has already been stored or deleted.
+  """
+  quote_id = quote.key().id()
+  shard = quote_id % SEARCH_SHARDS
+  keys = [_search_key(token, shard) for token in sorted(_search_tokens(quote.quote))]
+
+  def txn(keys):
+    changed = []
+    deleted = []
+    for key, entry in zip(keys, SearchIndexShard.get(keys)):
+      if entry is None:
+        if removed:
+          continue
+        entry = SearchIndexShard(key=key)
+      if removed:
+        if quote_id not in entry.ids:
+          continue
+        entry.ids.remove(quote_id)
+        if not entry.ids:
+          deleted.append(entry)
+          continue
+      else:
+        if quote_id in entry.ids:
+          continue
+        bisect.insort(entry.ids, quote_id)
+        del entry.ids[:-SEARCH_POSTING_LIMIT]
+      changed.append(entry)
+    db.put(changed)
+    db.delete(deleted)
+
+  options = db.create_transaction_options(xg=True)
+  try:
+    for i in range(0, len(keys), MAX_XG_GROUPS):
+      db.run_in_transaction_options(options, txn, keys[i:i + MAX_XG_GROUPS])
+  except db.Error, e:
+    logging.warning('Search index of quote %d not updated: %s' % (quote_id, e))
+  memcache.incr(SEARCH_GENERATION_KEY, initial_value=int(time.time()))
+
+
+def _search_hits(tokens):
+  """
+  Returns (votesum, id) of the quotes that contain every token, highest 
+  votesum first, cached for SEARCH_CACHE_TTL seconds or until a quote is 
+  added or removed. The posting lists of all the tokens are read in one 
+  batch, and the quotes matching them in another.
+  """
+  key = 'search|%d|%s' % (_generation(SEARCH_GENERATION_KEY), 
+                          ' '.join(tokens).encode('utf-8'))
+  hits = memcache.get(key)
+  if hits is not None:
+    return hits
+  entries = SearchIndexShard.get(
+      [_search_key(token, shard) for token in tokens for shard in range(SEARCH_SHARDS)])
+  postings = []
+  for i in range(len(tokens)):
+    ids = set()
+    for entry in entries[i * SEARCH_SHARDS:(i + 1) * SEARCH_SHARDS]:
+      if entry is not None:
+        ids.update(entry.ids)
+    postings.append(ids)
+  postings.sort(key=len)
+  matches = postings[0]
+  for ids in postings[1:]:
+    matches = matches.intersection(ids)
+  candidates = sorted(matches, reverse=True)[:SEARCH_MAX_CANDIDATES]
+  hits = []
+  if candidates:
+    hits = [(quote.votesum, quote.key().id()) 
+            for quote in get_quotes_by_ids(candidates) if quote is not None]
+    hits.sort(reverse=True)
+  memcache.set(key, hits, time=SEARCH_CACHE_TTL)
+  return hits
+
+
+def search_quotes(query, cursor=None):
+  """
+  Returns PAGE_SIZE quotes per page containing every word of 'query', 
+  the quotes with the most votes first.
+
+  Args
+    query:   The words to search for.
+    cursor:  The position to start the page after. This is the value of
+               'extra' returned from a previous call to this function.
+
+  Returns
+    (quotes, extra)
+  """
+  tokens = sorted(_search_tokens(query))[:SEARCH_MAX_TERMS]
+  if not tokens:
+    return [], None
+  hits = _search_hits(tokens)
+  if cursor:
+    try:
+      after = tuple([long(part) for part in cursor.split('|')])
+    except ValueError:
+      after = None
+    if after is not None:
+      hits = [hit for hit in hits if hit < after]
+  extra = None
+  if len(hits) > PAGE_SIZE:
+    hits = hits[:PAGE_SIZE]
+    extra = '%d|%d' % hits[-1]
+  quotes = get_quotes_by_ids([quote_id for (votesum, quote_id) in hits])
+  return [quote for quote in quotes if quote is not None], extra
+
+
+class Mapper(object):
+  """
+  Base class for walking every entity of a kind to recompute or backfill
+  properties, such as RerankMapper.
+
+  Entities are visited in key order, BATCH_SIZE at a time. map() is 
+  called on each and the ones it changed are written back together. 
+  After every batch the query cursor and counts are checkpointed in the 
+  mapper's MapperState, so a run picks up from the last completed batch 
+  after any failure. A batch may be mapped again if it fails after being 
+  written, so map() must be idempotent.
+
+  Each batch is run by a task of its own from /_tasks/mapper, and the 
+  next one is queued THROTTLE seconds later so a run doesn't crowd out 
+  serving. Tasks are named by run and batch, a retried or duplicated 
+  task finds the batch already done and does nothing.
+
+  Subclasses set NAME and KIND, override map(), and are listed in MAPPERS.
+  """
+  NAME = None
+  KIND = None
+  BATCH_SIZE = 100
+  THROTTLE = 1
+  # Write back in cross-group transactions that map a fresh copy of each
+  # entity, so that updates made while the batch was mapped aren't lost.
+  TRANSACTIONAL = False
+
+  def map(self, entity):
+    """Update 'entity' in place, returns True if it should be written back."""
+    raise NotImplementedError
+
+  def batch_done(self, changed):
+    """Called with the entities written back after each batch."""
+    pass
+
+  def state(self):
+    """Returns the MapperState of this mapper, or None if it has never run."""
+    return MapperState.get_by_key_name(self.NAME)
+
+  def start(self):
+    """Begin a new run from the first entity, returns its MapperState."""
+    def txn():
+      state = MapperState.get_by_key_name(self.NAME)
+      if state is None:
+        state = MapperState(key_name=self.NAME)
+      state.run += 1
+      state.cursor = None
+      state.batches = state.processed = state.changed = 0
+      state.seconds = 0.0
+      state.started = datetime.datetime.now()
+      state.checkpoint = None
+      state.done = False
+      state.put()
+      return state
+
+    state = db.run_in_transaction(txn)
+    self.schedule(state)
+    return state
+
+  def resume(self):
+    """
+    Carry on a run that has stopped, such as after its task was lost, 
+    from the last batch completed. The run gets a new number so its 
+    tasks aren't taken for those already used.
+
+    Returns
+      Its MapperState, or None if the mapper has never been run.
+    """
+    def txn():
+      state = MapperState.get_by_key_name(self.NAME)
+      if state is not None and not state.done:
+        state.run += 1
+        state.put()
+      return state
+
+    state = db.run_in_transaction(txn)
+    if state is not None and not state.done:
+      self.schedule(state)
+    return state
+
+  def schedule(self, state, countdown=0):
+    """Queue the task that runs the next batch after 'state'."""
+    name = 'mapper-%s-%d-%d' % (self.NAME, state.run, state.batches)
+    try:
+      taskqueue.add(name=name, url='/_tasks/mapper', countdown=countdown,
+          params={'name': self.NAME, 'run': state.run, 'batch': state.batches})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      pass
+
+  def run_batch(self, run, batch):
+    """
+    Map batch number 'batch' of run 'run' and checkpoint it.
+
+    Returns
+      The MapperState after the batch, or None if that batch isn't the 
+      next one to run.
+    """
+    state = self.state()
+    if state is None or state.run != run or state.batches != batch or state.done:
+      return None
+    start = time.time()
+    query = self.KIND.all()
+    if state.cursor:
+      query.with_cursor(state.cursor)
+    entities = query.fetch(self.BATCH_SIZE)
+    changed = [entity for entity in entities if self.map(entity)]
+    if changed:
+      changed = self._write(changed)
+    self.batch_done(changed)
+    state.cursor = query.cursor()
+    state.batches += 1
+    state.processed += len(entities)
+    state.changed += len(changed)
+    state.seconds += time.time() - start
+    state.checkpoint = datetime.datetime.now()
+    state.done = len(entities) < self.BATCH_SIZE
+    state.put()
+    return state
+
+  def _write(self, changed):
+    """Store the changed entities, returns those written."""
+    if not self.TRANSACTIONAL:
+      db.put(changed)
+      return changed
+
+    def txn(keys):
+      fresh = [entity for entity in db.get(keys) 
+               if entity is not None and self.map(entity)]
+      db.put(fresh)
+      return fresh
+
+    options = db.create_transaction_options(xg=True)
+    keys = [entity.key() for entity in changed]
+    written = []
+    for i in range(0, len(keys), MAX_XG_GROUPS):
+      written.extend(db.run_in_transaction_options(options, txn, keys[i:i + MAX_XG_GROUPS]))
+    return written
+
+
+class RerankMapper(Mapper):
+  """
+  Recomputes the score of every quote, and clears the rank string older
+  quotes were paged by. Run it after changing DAY_SCALE or _score(), and
+  when upgrading from the rank string, before the new version serves 
+  traffic, as README.md describes.
+  """
+  NAME = 'rerank'
+  KIND = Quote
+  TRANSACTIONAL = True
+
+  def map(self, quote):
+    score = _score(quote)
+    if quote.score == score and quote.rank is None:
+      return False
+    quote.score = score
+    quote.rank = None
+    return True
+
+  def batch_done(self, changed):
+    if changed:
+      _uncache_quotes([quote.key().id() for quote in changed])
+      memcache.delete(LEADERBOARD_KEY)
+      memcache.set("changed|popular", time.time())
+      _invalidate_lists()
+
+
+class SearchIndexMapper(Mapper):
+  """Adds every quote to the search index, for quotes stored before
+  there was one or whose index update failed."""
+  NAME = 'search_index'
+  KIND = Quote
+
+  def map(self, quote):
+    _index_quote(quote)
+    return False
+
+
+class FingerprintMapper(Mapper):
+  """Records the fingerprint, and shingles when DUPLICATE_SHINGLES is on, 
+  of the quotes stored before duplicates were detected. Duplicates that 
+  already exist are left as they are, the first one seen keeps the 
+  fingerprint."""
+  NAME = 'fingerprint'
+  KIND = Quote
+
+  def map(self, quote):
+    if _claim_fingerprint(quote.quote, quote.key().id()) is None and DUPLICATE_SHINGLES:
+      _claim_shingles(quote.quote, quote.key().id())
+    return False
+
+
+# The mappers /_tasks/mapper can run, by name.
+MAPPERS = dict([(mapper.NAME, mapper) for mapper in 
+                [RerankMapper(), SearchIndexMapper(), FingerprintMapper()]])
+
+  
+def get_quotes(offset=None, before=None):
+  """
+  Returns PAGE_SIZE quotes per page in score order.
+
+  Pages are found by score, the same way get_quotes_newest() pages by
+  creation_order, so a deep page costs no more than the first one.
+  
+  Args 
+    offset:  The score to start the page at. This is the value of 'extra'
+               returned from a previous call to this function.
+    before:  For paging backwards, the score of the first quote on the 
+               page following the one wanted. Used instead of offset.
+    
+  Returns
+    (quotes, extra)
+  """
   extra = None
-  quotes = Quote.gql('ORDER BY rank DESC').fetch(PAGE_SIZE+1, page*PAGE_SIZE)
+  if before is not None:
+    quotes = Quote.gql('WHERE score > :1 ORDER BY score', before).fetch(PAGE_SIZE + 1)
+    if len(quotes) > PAGE_SIZE:
+      quotes = quotes[:PAGE_SIZE]
+      quotes.reverse()
+      return quotes, before
+    # Less than a page to go back, start again from the top.
+    offset = None
+  if offset is None:
+    quotes = _get_leaderboard()
+  else:
+    quotes = Quote.gql("""WHERE score <= :1 
+             ORDER BY score DESC""", offset).fetch(PAGE_SIZE + 1)
   if len(quotes) > PAGE_SIZE:
-    if page < 19:
-      extra = quotes[-1]
+    extra = quotes[-1].score
     quotes = quotes[:PAGE_SIZE]
   return quotes, extra
 
+
+def _list_key(section, offset, before):
+  """Returns the memcache key of a page cached by get_list()."""
+  return '%s|%s|%s' % (section, offset, before)
+
+
+def get_list(section, offset=None, before=None):
+  """
+  Returns a page of the 'popular' or 'recent' quotes, as get_quotes() or 
+  get_quotes_newest() would, from memcache.
+
+  When the cached page is stale the first request to see it queues a 
+  task to run refresh_list(), and it and every other request get the 
+  stale page in the meantime, so a change to the lists doesn't send all 
+  the requests for a page to the datastore at once. A page is only read
+  while the request waits if it isn't in memcache at all.
+
+  Args 
+    section:  'popular' or 'recent'.
+    offset:   As for get_quotes() or get_quotes_newest().
+    before:   As for get_quotes(), always None for 'recent'.
+
+  Returns
+    (quotes, extra, stale), where stale is None if the page is current 
+    and otherwise the time it was read, in seconds since the epoch.
+  """
+  key = _list_key(section, offset, before)
+  entry = memcache.get(LIST_CACHE_PREFIX + key)
+  if entry is None:
+    quotes, extra = refresh_list(section, offset, before)
+    return quotes, extra, None
+  stale = None
+  if (entry['read'] <= last_changed(section) or 
+      entry['read'] + LIST_SOFT_TTL < time.time()):
+    stale = entry['read']
+  if stale and memcache.add(LIST_REFRESH_PREFIX + key, 1, time=LIST_SOFT_TTL):
+    params = {'section': section}
+    if offset is not None:
+      params['offset'] = offset
+    if before is not None:
+      params['before'] = before
+    try:
+      taskqueue.add(url='/_tasks/refresh_list', params=params)
+    except taskqueue.Error:
+      logging.warning('Could not queue a refresh of list page %s', key)
+  return [_decode_quote(data) for data in entry['quotes']], entry['extra'], stale
+
+
+def refresh_list(section, offset=None, before=None):
+  """
+  Read a page of the 'popular' or 'recent' quotes into the memcache
+  entry get_list() serves it from, and let the next request that finds
+  it stale queue another refresh. Returns (quotes, extra).
+  """
+  read = time.time()
+  if section == 'popular':
+    quotes, extra = get_quotes(offset, before)
+  else:
+    quotes, extra = get_quotes_newest(offset)
+  memcache.set(LIST_CACHE_PREFIX + _list_key(section, offset, before), {
+      'read': read,
+      'quotes': [_encode_quote(quote) for quote in quotes],
+      'extra': extra,
+    }, time=LIST_CACHE_TTL)
+  memcache.delete(LIST_REFRESH_PREFIX + _list_key(section, offset, before))
+  return quotes, extra
+
   
 def voted(quote, user):
   """Returns the value of a users vote on the specified quote, a value in [-1, 0, 1]."""
-  val = 0
-  if user:
-    memcachekey = "vote|" + user.email() + "|" + str(quote.key().id())
-    val = memcache.get(memcachekey)
-    if val is not None:
-      return val
-    vote = Vote.get_by_key_name(key_names = user.email(), parent = quote)
-    if vote is not None:
-      val = vote.vote
-      memcache.set(memcachekey, val)
-  return val
+  return voted_multi([quote], user)[0]
+
+
+def voted_multi(quotes, user):
+  """
+  Returns the users vote on each of the given quotes, in the same order.
+
+  All the lookups are batched: one memcache get for the whole list, one
+  datastore get for the votes that were not in memcache, and one memcache
+  add to fill in what was found. A quote the user has not voted on is
+  cached as 0 so it doesn't go back to the datastore on the next page view.
+  It is an add so that a vote cached while the datastore was being read,
+  including one queued for drain_votes(), isn't replaced by the older value.
+  """
+  if not user or not quotes:
+    return [0] * len(quotes)
+  prefix = "vote|" + user.email() + "|"
+  ids = [str(quote.key().id()) for quote in quotes]
+  cached = memcache.get_multi(ids, key_prefix=prefix)
+  missing = [(id, quote) for (id, quote) in zip(ids, quotes) if id not in cached]
+  if missing:
+    keys = [_vote_key(quote, user.email()) for (id, quote) in missing]
+    found = {}
+    for (id, quote), vote in zip(missing, Vote.get(keys)):
+      if vote is not None:
+        found[id] = vote.vote
+      else:
+        found[id] = 0
+    memcache.add_multi(found, key_prefix=prefix)
+    cached.update(found)
+  return [cached[id] for id in ids]
 
@@ -0,0 +1,100 @@
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Rate limits on the expensive requests, kept in memcache.
+
+Each RateLimit allows a number of requests per period from each user
+and from each IP address. Requests are counted in a memcache counter
+per period, and the count of the previous period is weighted by how
+much of it still falls within the last 'period' seconds, a sliding
+window that costs one offset_multi and one get_multi per check, and no
+datastore access at all. If memcache is unavailable requests are let
+through.
+
+"""
+
+import time
+
+from google.appengine.api import memcache
+
+_PREFIX = 'ratelimit|'
+
+
+class RateLimit(object):
+  """
+  A limit on the requests of one kind.
+
+  Properties
+    name:      Names the limit in memcache keys and the rejection counts.
+    per_user:  Requests allowed per period from each user, or None for no limit.
+    per_ip:    Requests allowed per period from each IP address, or None.
+    period:    Length of the window in seconds.
+  """
+
+  def __init__(self, name, per_user, per_ip, period=60):
+    self.name = name
+    self.per_user = per_user
+    self.per_ip = per_ip
+    self.period = period
+
+  def allow(self, email, ip, cost=1, now=None):
+    """
+    Count a request from the user with 'email', which may be None, at
+    address 'ip'. A request of several actions, like a batch of votes,
+    passes their number as 'cost'.
+
+    Returns True if the request is within the limits, otherwise counts
+    the rejection and returns False.
+    """
+    if now is None:
+      now = time.time()
+    window = int(now / self.period)
+    weight = 1.0 - (now % self.period) / self.period
+    limits = []
+    if email and self.per_user:
+      limits.append(('user|' + email, self.per_user))
+    if ip and self.per_ip:
+      limits.append(('ip|' + ip, self.per_ip))
+    if not limits:
+      return True
+    current = dict([('%s|%s|%d' % (self.name, who, window), cost) for who, limit in limits])
+    counts = memcache.offset_multi(current, key_prefix=_PREFIX, initial_value=0)
+    previous = memcache.get_multi(['%s|%s|%d' % (self.name, who, window - 1)
+                                   for who, limit in limits], key_prefix=_PREFIX)
+    for who, limit in limits:
+      count = counts.get('%s|%s|%d' % (self.name, who, window))
+      if count is None:
+        continue
+      count += previous.get('%s|%s|%d' % (self.name, who, window - 1), 0) * weight
+      if count > limit:
+        memcache.incr(_PREFIX + 'rejected|' + self.name, initial_value=0)
+        return False
+    return True
+
+
+# Votes, single or batched, counting each vote in a batch.
+VOTES = RateLimit('vote', per_user=60, per_ip=300, period=60)
+
+# New quotes.
+QUOTES = RateLimit('quote', per_user=10, per_ip=30, period=600)
+
+LIMITS = [VOTES, QUOTES]
+
+
+def get_rejections():
+  """Returns a list of (name, requests rejected) for each of LIMITS."""
+  counts = memcache.get_multi(['rejected|' + limit.name for limit in LIMITS],
+                              key_prefix=_PREFIX)
+  return [(limit.name, counts.get('rejected|' + limit.name, 0)) for limit in LIMITS]
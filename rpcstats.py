@@ -0,0 +1,201 @@
+# Copyright 2008 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""Accounting of the API calls made while serving each request.
+
+Hooks on the API proxy count every call by service, method and the
+application function that made it, along with the bytes sent and
+received and the time taken. RpcStatsMiddleware collects the counts
+for each request and adds them to totals kept in memcache, which
+get_totals() returns for the /_stats page.
+
+"""
+
+import sys
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api import memcache
+
+# Modules whose functions API calls are charged to.
+APP_MODULES = ('models', 'main')
+
+# Add an X-RPC-Stats header with the totals for the request to each
+# response, useful when load testing.
+SEND_HEADER = False
+
+_PREFIX = 'rpcstats|'
+_LABELS_KEY = _PREFIX + 'labels'
+LABELS_RETRIES = 5
+
+_local = threading.local()
+
+# Labels this instance knows are already in the memcache list of labels.
+_known_labels = set()
+
+
+class RequestStats(object):
+  """The API calls made while serving a single request.
+
+  Properties
+    calls:    Maps (service.method, caller) to [count, bytes, milliseconds].
+    started:  Start time of each call in progress, by the id of its request.
+  """
+
+  def __init__(self):
+    self.calls = {}
+    self.started = {}
+
+  def totals(self):
+    """Returns (calls by service, bytes, milliseconds) for the request."""
+    services = {}
+    size = 0
+    elapsed = 0.0
+    for (method, caller), (count, nbytes, ms) in self.calls.items():
+      service = method.split('.')[0]
+      services[service] = services.get(service, 0) + count
+      size += nbytes
+      elapsed += ms
+    return services, size, elapsed
+
+
+def _caller():
+  """Returns the name of the application function making an API call."""
+  frame = sys._getframe(2)
+  while frame is not None:
+    module = frame.f_globals.get('__name__')
+    if module in APP_MODULES and frame.f_code.co_name != 'txn':
+      return '%s.%s' % (module, frame.f_code.co_name)
+    frame = frame.f_back
+  return 'other'
+
+
+def _before_call(service, call, request, response):
+  stats = getattr(_local, 'stats', None)
+  if stats is not None:
+    stats.started[id(request)] = time.time()
+
+
+def _after_call(service, call, request, response):
+  stats = getattr(_local, 'stats', None)
+  if stats is None:
+    return
+  started = stats.started.pop(id(request), None)
+  if started is None:
+    return
+  key = ('%s.%s' % (service, call), _caller())
+  entry = stats.calls.setdefault(key, [0, 0, 0.0])
+  entry[0] += 1
+  entry[1] += request.ByteSize() + response.ByteSize()
+  entry[2] += (time.time() - started) * 1000
+
+
+def install():
+  """Add the hooks to the current API proxy, if they aren't there already."""
+  apiproxy = apiproxy_stub_map.apiproxy
+  apiproxy.GetPreCallHooks().Append('rpcstats', _before_call)
+  apiproxy.GetPostCallHooks().Append('rpcstats', _after_call)
+
+
+def _record(stats):
+  """Add the calls made by a request to the totals in memcache.
+
+  Labels new to this instance are added to the memcache list of labels
+  with compare-and-set, so labels added by other instances at the same
+  time are not lost. They are only marked as known once they are in the
+  list; if the list can't be updated they are tried again next request.
+  """
+  offsets = {'requests': 1}
+  labels = []
+  for (method, caller), (count, nbytes, ms) in stats.calls.items():
+    label = '%s|%s' % (method, caller)
+    labels.append(label)
+    offsets[label + '|count'] = count
+    offsets[label + '|bytes'] = nbytes
+    offsets[label + '|ms'] = int(ms)
+  memcache.offset_multi(offsets, key_prefix=_PREFIX, initial_value=0)
+  new_labels = [label for label in labels if label not in _known_labels]
+  if new_labels:
+    _add_labels(new_labels)
+
+
+def _add_labels(new_labels):
+  """Add labels to the memcache list of labels, returning whether it worked."""
+  client = memcache.Client()
+  for i in range(LABELS_RETRIES):
+    known = client.gets(_LABELS_KEY)
+    if known is None:
+      saved = client.add(_LABELS_KEY, sorted(set(new_labels)))
+    elif set(new_labels).issubset(known):
+      saved = True
+    else:
+      saved = client.cas(_LABELS_KEY, sorted(set(known + new_labels)))
+    if saved:
+      _known_labels.update(new_labels)
+      return True
+  return False
+
+
+def get_totals():
+  """
+  Returns (requests, totals) for all the requests recorded, where totals
+  is a list of dictionaries with the 'method', 'caller', 'count', 'bytes'
+  and 'ms' of the calls, busiest first.
+  """
+  labels = memcache.get(_LABELS_KEY) or []
+  keys = ['requests']
+  for label in labels:
+    keys.extend([label + '|count', label + '|bytes', label + '|ms'])
+  values = memcache.get_multi(keys, key_prefix=_PREFIX)
+  totals = []
+  for label in labels:
+    method, caller = label.split('|', 1)
+    totals.append({
+      'method': method,
+      'caller': caller,
+      'count': values.get(label + '|count', 0),
+      'bytes': values.get(label + '|bytes', 0),
+      'ms': values.get(label + '|ms', 0),
+    })
+  totals.sort(key=lambda total: total['count'], reverse=True)
+  return values.get('requests', 0), totals
+
+
+class RpcStatsMiddleware(object):
+  """WSGI middleware that accounts for the API calls made by each request."""
+
+  def __init__(self, application):
+    self.application = application
+
+  def __call__(self, environ, start_response):
+    install()
+    stats = RequestStats()
+    _local.stats = stats
+
+    def stats_start_response(status, headers, exc_info=None):
+      if SEND_HEADER:
+        services, size, elapsed = stats.totals()
+        summary = ['%s=%d' % item for item in sorted(services.items())]
+        summary.append('bytes=%d' % size)
+        summary.append('ms=%.1f' % elapsed)
+        headers.append(('X-RPC-Stats', ';'.join(summary)))
+      return start_response(status, headers, exc_info)
+
+    try:
+      return self.application(environ, stats_start_response)
+    finally:
+      _local.stats = None
+      _record(stats)
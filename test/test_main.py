@@ -0,0 +1,49 @@
+import main
+import models
+import unittest
+import urllib
+from google.appengine.api import users
+from google.appengine.ext import webapp
+
+
+def get(handler_class, url):
+  """Run a GET of 'url' through a new handler, returns the handler."""
+  handler = handler_class()
+  handler.initialize(webapp.Request.blank(url), webapp.Response())
+  handler.get()
+  return handler
+
+
+class TestHandlers(unittest.TestCase):
+
+  def setUp(self):
+    # Each test gets a new datastore, which reuses quote ids.
+    models._quote_cache.clear()
+
+  def test_api_quotes(self):
+    """
+    The JSON quote list serves the first page of a section when there
+    is no cursor, and the following page from the cursor it returns.
+    """
+    user = users.User('fred@example.com')
+    ids = [models.add_quote('This is test %d.' % i, user, _created=1) 
+           for i in range(models.PAGE_SIZE + 1)]
+    for url in ['/api/quotes', '/api/quotes?section=popular', '/api/quotes?section=recent']:
+      handler = get(main.ApiQuotesHandler, url)
+      page = main.json.loads(handler.response.out.getvalue())
+      self.assertEqual(len(page['quotes']), models.PAGE_SIZE)
+      self.assertNotEqual(page['next'], None)
+
+      section = url.endswith('recent') and 'recent' or 'popular'
+      handler = get(main.ApiQuotesHandler, '/api/quotes?' + urllib.urlencode(
+          {'section': section, 'cursor': page['next']}))
+      page = main.json.loads(handler.response.out.getvalue())
+      self.assertEqual(len(page['quotes']), 1)
+      self.assertEqual(page['next'], None)
+
+    for quoteid in ids:
+      models.del_quote(quoteid, user)
+
+
+if __name__ == '__main__':
+    unittest.main()
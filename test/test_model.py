@@ -1,8 +1,9 @@
+import datetime
 import models
 import os
 import sys
 import unittest
-import time
+from google.appengine.api import memcache
 from google.appengine.api import users
 from google.appengine.api import urlfetch
 from google.appengine.api import apiproxy_stub_map
@@ -11,15 +12,24 @@ from google.appengine.api import user_service_stub
 
         
 class TestModel(unittest.TestCase):
+
+  def setUp(self):
+    # Each test gets a new datastore, which reuses quote ids.
+    models._quote_cache.clear()
     
   def test_add_quote(self):
     """
     Add and remove quotes from the system.
     """
     user = users.User('joe@example.com')
-    quoteid = models.add_quote('This is a test.', user)
-    time.sleep(1.1)
-    quoteid2 = models.add_quote('This is a test2.', user)
+    ticks = [datetime.datetime(2008, 10, 11, 12, 0, 0),
+             datetime.datetime(2008, 10, 11, 12, 0, 1)]
+    models._now = lambda: ticks.pop(0)
+    try:
+      quoteid = models.add_quote('This is a test.', user)
+      quoteid2 = models.add_quote('This is a test2.', user)
+    finally:
+      models._now = datetime.datetime.now
     self.assertNotEqual(quoteid, None)
     self.assertNotEqual(quoteid, 0)
     
@@ -81,13 +91,13 @@ class TestModel(unittest.TestCase):
     """
     user = users.User('joe@example.com')
     for i in range(models.PAGE_SIZE):
-      quoteid = models.add_quote('This is a test.', user)
+      quoteid = models.add_quote('This is test %d.' % i, user)
       self.assertNotEqual(quoteid, None)
     quotes, next = models.get_quotes_newest()
     self.assertEqual(len(quotes), models.PAGE_SIZE)
     self.assertEqual(next, None)
 
-    quoteid = models.add_quote('This is a test.', user)
+    quoteid = models.add_quote('This is one more test.', user)
     self.assertNotEqual(quoteid, None)
     
     quotes, next = models.get_quotes_newest()
@@ -105,6 +115,55 @@ class TestModel(unittest.TestCase):
     for q in quotes:
       models.del_quote(q.key().id(), user)
     
+  def test_paging_popular(self):
+    """
+    Test that we can page forwards and backwards through 
+    the quotes in rank order.
+    """
+    user = users.User('joe@example.com')
+    ids = []
+    for i in range(models.PAGE_SIZE + 1):
+      quoteid = models.add_quote('This is test %d.' % i, user, _created=1)
+      self.assertNotEqual(quoteid, None)
+      models.set_vote(quoteid, user, i + 1)
+      ids.append(quoteid)
+    ids.reverse()
+
+    quotes, next = models.get_quotes()
+    self.assertEqual([q.key().id() for q in quotes], ids[:models.PAGE_SIZE])
+    self.assertNotEqual(next, None)
+
+    quotes, next2 = models.get_quotes(next)
+    self.assertEqual([q.key().id() for q in quotes], ids[models.PAGE_SIZE:])
+    self.assertEqual(next2, None)
+
+    # Going back from the second page returns the first.
+    quotes, extra = models.get_quotes(before=quotes[0].score)
+    self.assertEqual([q.key().id() for q in quotes], ids[:models.PAGE_SIZE])
+    self.assertEqual(extra, next)
+
+    # Going back from a quote with a full page above it.
+    quotes, extra = models.get_quotes(before=models.get_quote(ids[-1]).score)
+    self.assertEqual([q.key().id() for q in quotes], ids[:models.PAGE_SIZE])
+    self.assertEqual(extra, models.get_quote(ids[-1]).score)
+
+    for quoteid in ids:
+      models.del_quote(quoteid, user)
+
+  def test_creation_order_unique(self):
+    """
+    Quotes added by the same user in the same second still 
+    get distinct creation_order values.
+    """
+    user = users.User('joe@example.com')
+    ids = [models.add_quote('This is test %d.' % i, user) for i in range(5)]
+    orders = [models.get_quote(quoteid).creation_order for quoteid in ids]
+    self.assertEqual(len(set(orders)), 5)
+    for order in orders:
+      self.assertFalse('joe' in order)
+    for quoteid in ids:
+      models.del_quote(quoteid, user)
+
   def test_game_progress(self):
     email = 'fred@example.com'
     user = users.User(email)
@@ -138,8 +197,8 @@ class TestModel(unittest.TestCase):
     # q0 (5) = 1 * 4 + 5 = 9 
     # q1 (3) = 1 * 4 + 3 = 7 
 
-    quoteid0 = models.add_quote('This is a test.', user, _created=1)
-    quoteid1 = models.add_quote('This is a test.', user, _created=1)    
+    quoteid0 = models.add_quote('This is test 0.', user, _created=1)
+    quoteid1 = models.add_quote('This is test 1.', user, _created=1)    
     models.set_vote(quoteid0, user, 1)
     models.set_vote(quoteid1, user, 3)
     quotes, next = models.get_quotes()
@@ -158,7 +217,7 @@ class TestModel(unittest.TestCase):
     # q0 (5) + (3) = 1 * 4 + 8 = 12
     # q1 (3) + (0) = 1 * 4 + 3 = 7 
     # q2       (3) = 2 * 4 + 3 = 11
-    quoteid2 = models.add_quote('This is a test.', user, _created=2)
+    quoteid2 = models.add_quote('This is test 2.', user, _created=2)
 
     models.set_vote(quoteid0, user, 8)
     models.set_vote(quoteid1, user, 3)
@@ -175,7 +234,7 @@ class TestModel(unittest.TestCase):
     # q2       (3) + (2) = 2 * 5 + 4 = 14
     # q3             (5) = 3 * 4 + 5 = 17      
 
-    quoteid3 = models.add_quote('This is a test.', user, _created=3)
+    quoteid3 = models.add_quote('This is test 3.', user, _created=3)
 
     models.set_vote(quoteid0, user, 8)
     models.set_vote(quoteid1, user, 3)
@@ -208,6 +267,563 @@ class TestModel(unittest.TestCase):
     models.del_quote(quoteid2, user)
     models.del_quote(quoteid3, user)
 
+  def test_set_votes(self):
+    """
+    Several votes recorded at once give the same result 
+    as recording them one at a time.
+    """
+    user = users.User('fred@example.com')
+    quoteid0 = models.add_quote('This is test 0.', user, _created=1)
+    quoteid1 = models.add_quote('This is test 1.', user, _created=1)
+    models.set_vote(quoteid1, user, -1)
+
+    results = models.set_votes(user, [(quoteid0, 1), (quoteid1, -1), (999999, 1)])
+    self.assertEqual(results, ['ok', 'unchanged', 'not_found'])
+    self.assertEqual(models.get_quote(quoteid0).votesum, 1)
+    self.assertEqual(models.get_quote(quoteid1).votesum, -1)
+    quotes, next = models.get_quotes()
+    self.assertEqual(quotes[0].key().id(), quoteid0)
+    self.assertEqual(models.voted_multi(quotes, user), [1, -1])
+
+    results = models.set_votes(user, [(quoteid0, -1), (quoteid1, 1)])
+    self.assertEqual(results, ['ok', 'ok'])
+    self.assertEqual(models.get_quote(quoteid0).votesum, -1)
+    self.assertEqual(models.get_quote(quoteid1).votesum, 1)
+    quotes, next = models.get_quotes()
+    self.assertEqual(quotes[0].key().id(), quoteid1)
+
+    # A transaction that fails is reported, not raised.
+    def fail(*args, **kwargs):
+      raise models.db.TransactionFailedError()
+    run_in_transaction = models._run_in_transaction
+    models._run_in_transaction = fail
+    try:
+      results = models.set_votes(user, [(quoteid0, 1), (999999, 1)])
+    finally:
+      models._run_in_transaction = run_in_transaction
+    self.assertEqual(results, ['failed', 'not_found'])
+    self.assertEqual(models.get_quote(quoteid0).votesum, -1)
+
+    models.del_quote(quoteid0, user)
+    models.del_quote(quoteid1, user)
+
+  def test_voted_multi(self):
+    """
+    Batched vote lookups agree with looking up each vote on its own.
+    """
+    user = users.User('fred@example.com')
+    user2 = users.User('barney@example.com')
+    quoteid0 = models.add_quote('This is test 0.', user, _created=1)
+    quoteid1 = models.add_quote('This is test 1.', user, _created=1)
+    quoteid2 = models.add_quote('This is test 2.', user, _created=1)
+    models.set_vote(quoteid0, user, 1)
+    models.set_vote(quoteid2, user, -1)
+    quotes = [models.get_quote(id) for id in [quoteid0, quoteid1, quoteid2]]
+
+    self.assertEqual(models.voted_multi(quotes, user), [1, 0, -1])
+    self.assertEqual(models.voted_multi(quotes, user2), [0, 0, 0])
+    self.assertEqual(models.voted_multi(quotes, None), [0, 0, 0])
+    self.assertEqual(models.voted_multi([], user), [])
+    for quote in quotes:
+      self.assertEqual(models.voted(quote, user), 
+                       models.voted_multi([quote], user)[0])
+
+    # A vote changed after the lookup was cached is still seen.
+    models.set_vote(quoteid1, user, -1)
+    self.assertEqual(models.voted_multi(quotes, user), [1, -1, -1])
+
+    models.del_quote(quoteid0, user)
+    models.del_quote(quoteid1, user)
+    models.del_quote(quoteid2, user)
+
+  def test_list_generation(self):
+    """
+    Every change to the quote lists moves them on to a new generation.
+    """
+    user = users.User('fred@example.com')
+    generation = models.list_generation()
+    self.assertEqual(models.list_generation(), generation)
+
+    quoteid = models.add_quote('This is a test.', user)
+    self.assertNotEqual(models.list_generation(), generation)
+
+    generation = models.list_generation()
+    models.set_vote(quoteid, user, 1)
+    self.assertNotEqual(models.list_generation(), generation)
+
+    # Voting the same way again changes nothing.
+    generation = models.list_generation()
+    models.set_vote(quoteid, user, 1)
+    self.assertEqual(models.list_generation(), generation)
+
+    models.del_quote(quoteid, user)
+    self.assertNotEqual(models.list_generation(), generation)
+
+  def test_last_changed(self):
+    """
+    Adding and removing quotes changes both sections, 
+    voting only changes the popular section.
+    """
+    user = users.User('fred@example.com')
+    popular = models.last_changed('popular')
+    recent = models.last_changed('recent')
+    self.assertEqual(models.last_changed('popular'), popular)
+
+    quoteid = models.add_quote('This is a test.', user)
+    self.assertTrue(models.last_changed('popular') > popular)
+    self.assertTrue(models.last_changed('recent') > recent)
+
+    popular = models.last_changed('popular')
+    recent = models.last_changed('recent')
+    models.set_vote(quoteid, user, 1)
+    self.assertTrue(models.last_changed('popular') > popular)
+    self.assertEqual(models.last_changed('recent'), recent)
+
+    models.del_quote(quoteid, user)
+    self.assertTrue(models.last_changed('recent') > recent)
+
+  def test_sharded_votes(self):
+    """
+    Votes on a sharded quote are idempotent per user and are 
+    rolled up into the same votesum and rank as an unsharded quote.
+    """
+    user = users.User('fred@example.com')
+    user2 = users.User('barney@example.com')
+    models.VOTE_SHARDS = 4
+    try:
+      quoteid0 = models.add_quote('This is test 0.', user, _created=1)
+    finally:
+      models.VOTE_SHARDS = 0
+    quoteid1 = models.add_quote('This is test 1.', user, _created=1)
+    self.assertEqual(models.get_quote(quoteid0).shards, 4)
+    self.assertEqual(models.get_quote(quoteid1).shards, 0)
+
+    models.set_vote(quoteid0, user, 1)
+    models.set_vote(quoteid0, user, 1)
+    models.set_vote(quoteid0, user2, 1)
+    models.set_vote(quoteid1, user, 1)
+    self.assertEqual(models.voted(models.get_quote(quoteid0), user), 1)
+
+    models.rollup_votes(quoteid0)
+    self.assertEqual(models.get_quote(quoteid0).votesum, 2)
+    quotes, next = models.get_quotes()
+    self.assertEqual(quotes[0].key().id(), quoteid0)
+    self.assertEqual(quotes[1].key().id(), quoteid1)
+
+    # Changing a vote moves the votesum by the difference only.
+    models.set_vote(quoteid0, user2, -1)
+    models.rollup_votes(quoteid0)
+    self.assertEqual(models.get_quote(quoteid0).votesum, 0)
+    self.assertEqual(models.voted(models.get_quote(quoteid0), user2), -1)
+    quotes, next = models.get_quotes()
+    self.assertEqual(quotes[0].key().id(), quoteid1)
+    self.assertEqual(quotes[1].key().id(), quoteid0)
+
+    models.del_quote(quoteid0, user)
+    models.del_quote(quoteid1, user)
+
+  def test_write_behind_votes(self):
+    """
+    Queued votes read back straight away, and only the last vote 
+    of each user on each quote is applied when the queue is drained.
+    """
+    user = users.User('fred@example.com')
+    user2 = users.User('barney@example.com')
+    queue = models.vote_queue
+    models.vote_queue = models.LocalVoteQueue()
+    try:
+      quoteid0 = models.add_quote('This is test 0.', user, _created=1)
+      quoteid1 = models.add_quote('This is test 1.', user, _created=1)
+      models.enqueue_vote(quoteid0, user, 1)
+      models.enqueue_vote(quoteid0, user, -1)
+      models.enqueue_vote(quoteid0, user2, 1)
+      models.enqueue_vote(quoteid1, user, 1)
+      models.enqueue_vote(quoteid1, user2, 1)
+      self.assertEqual(models.voted(models.get_quote(quoteid0), user), -1)
+      self.assertEqual(models.get_quote(quoteid0).votesum, 0)
+
+      self.assertEqual(models.drain_votes(), 5)
+      self.assertEqual(models.drain_votes(), 0)
+      self.assertEqual(models.get_quote(quoteid0).votesum, 0)
+      self.assertEqual(models.get_quote(quoteid1).votesum, 2)
+      self.assertEqual(models.voted(models.get_quote(quoteid0), user), -1)
+      self.assertEqual(models.voted(models.get_quote(quoteid0), user2), 1)
+
+      quotes, next = models.get_quotes()
+      self.assertEqual(quotes[0].key().id(), quoteid1)
+      self.assertEqual(quotes[1].key().id(), quoteid0)
+      hasVoted, hasAddedQuote = models.get_progress(user2)
+      self.assertTrue(hasVoted)
+    finally:
+      models.vote_queue = queue
+    models.del_quote(quoteid0, user)
+    models.del_quote(quoteid1, user)
+
+  def test_leaderboard(self):
+    """
+    The first page of popular quotes, which is served from the 
+    leaderboard, stays in the same order as the score index.
+    """
+    user = users.User('fred@example.com')
+    ids = [models.add_quote('This is test %d.' % i, user, _created=1) 
+           for i in range(models.PAGE_SIZE + 2)]
+    for i, quoteid in enumerate(ids):
+      models.set_vote(quoteid, user, i + 1)
+
+    def check():
+      quotes, next = models.get_quotes()
+      index = models.Quote.gql('ORDER BY score DESC').fetch(models.PAGE_SIZE)
+      self.assertEqual([q.key().id() for q in quotes], 
+                       [q.key().id() for q in index])
+
+    check()
+    # Move a quote from the bottom to the top and back again.
+    models.set_vote(ids[0], user, 100)
+    check()
+    models.set_vote(ids[0], user, -100)
+    check()
+    models.del_quote(ids[-1], user)
+    check()
+    memcache.delete(models.LEADERBOARD_KEY)
+    check()
+    check()
+    # An update carrying an older copy of a quote doesn't replace the newer one.
+    older = models.Quote.get_by_id(ids[1])
+    models.set_vote(ids[1], user, 100)
+    models._update_leaderboard(older)
+    quotes, next = models.get_quotes()
+    self.assertEqual((quotes[0].key().id(), quotes[0].votesum), (ids[1], 100))
+    check()
+
+    for quoteid in ids[:-1]:
+      models.del_quote(quoteid, user)
+    quotes, next = models.get_quotes()
+    self.assertEqual(len(quotes), 0)
+
+  def test_rerank_mapper(self):
+    """
+    The rerank mapper scores quotes stored with only the old rank string
+    and rescores the rest after DAY_SCALE changes, a batch at a time.
+    """
+    user = users.User('fred@example.com')
+    ids = [models.add_quote('This is test %d.' % i, user, _created=1) for i in range(3)]
+    legacy = models.get_quote(ids[0])
+    legacy.rank = '%020d|%s' % (4, legacy.creation_order)
+    legacy.score = None
+    legacy.put()
+
+    mapper = models.RerankMapper()
+    mapper.BATCH_SIZE = 2
+    models.DAY_SCALE = 8
+    try:
+      state = mapper.start()
+      while not state.done:
+        state = mapper.run_batch(state.run, state.batches)
+    finally:
+      models.DAY_SCALE = 4
+    self.assertEqual(state.batches, 2)
+    self.assertEqual(state.processed, 3)
+    self.assertEqual(state.changed, 3)
+    # A repeated task for a batch already done does nothing.
+    self.assertEqual(mapper.run_batch(state.run, 0), None)
+
+    legacy = models.get_quote(ids[0])
+    self.assertEqual(legacy.rank, None)
+    self.assertEqual(legacy.score >> models.SCORE_TIEBREAK_BITS, 8)
+    quotes, next = models.get_quotes()
+    self.assertEqual([q.key().id() for q in quotes], ids[::-1])
+
+    for quoteid in ids:
+      models.del_quote(quoteid, user)
+
+  def test_mapper_resume(self):
+    """
+    A stopped run resumes from its last checkpoint under a new run 
+    number, so the tasks of the old run do nothing.
+    """
+    user = users.User('fred@example.com')
+    ids = [models.add_quote('This is test %d.' % i, user, _created=1) for i in range(3)]
+    mapper = models.SearchIndexMapper()
+    mapper.BATCH_SIZE = 2
+    self.assertEqual(mapper.resume(), None)
+    state = mapper.start()
+    state = mapper.run_batch(state.run, 0)
+    self.assertEqual(state.batches, 1)
+
+    resumed = mapper.resume()
+    self.assertEqual(resumed.run, state.run + 1)
+    self.assertEqual(resumed.batches, 1)
+    self.assertEqual(mapper.run_batch(state.run, 1), None)
+    state = mapper.run_batch(resumed.run, 1)
+    self.assertTrue(state.done)
+    self.assertEqual(state.processed, 3)
+
+    for quoteid in ids:
+      models.del_quote(quoteid, user)
+
+    
+  def test_search(self):
+    """
+    Quotes are found by all of the words in a query, whatever their 
+    case or punctuation, most votes first, until they are removed.
+    """
+    user = users.User('fred@example.com')
+    quoteid0 = models.add_quote('The quick brown fox.', user)
+    quoteid1 = models.add_quote('A lazy, BROWN dog!', user)
+    quoteid2 = models.add_quote('Quick thinking.', user)
+    models.set_vote(quoteid1, user, 1)
+
+    quotes, extra = models.search_quotes('brown')
+    self.assertEqual([q.key().id() for q in quotes], [quoteid1, quoteid0])
+    self.assertEqual(extra, None)
+    quotes, extra = models.search_quotes('QUICK brown')
+    self.assertEqual([q.key().id() for q in quotes], [quoteid0])
+    quotes, extra = models.search_quotes('the')
+    self.assertEqual(quotes, [])
+
+    models.del_quote(quoteid0, user)
+    quotes, extra = models.search_quotes('quick')
+    self.assertEqual([q.key().id() for q in quotes], [quoteid2])
+    models.del_quote(quoteid1, user)
+    models.del_quote(quoteid2, user)
+    quotes, extra = models.search_quotes('brown')
+    self.assertEqual(quotes, [])
+
+  def test_search_paging(self):
+    """
+    Search results are paged with the cursor returned for each page.
+    """
+    user = users.User('fred@example.com')
+    ids = [models.add_quote('Paging test %d.' % i, user) 
+           for i in range(models.PAGE_SIZE + 1)]
+    quotes, extra = models.search_quotes('paging test')
+    self.assertEqual(len(quotes), models.PAGE_SIZE)
+    self.assertNotEqual(extra, None)
+    more, extra = models.search_quotes('paging test', extra)
+    self.assertEqual(len(more), 1)
+    self.assertEqual(extra, None)
+    self.assertEqual(sorted([q.key().id() for q in quotes + more]), sorted(ids))
+    for quoteid in ids:
+      models.del_quote(quoteid, user)
+
+    
+  def test_duplicate_quotes(self):
+    """
+    Adding a quote that differs from an existing one only in case, 
+    whitespace or punctuation returns the existing quote, until it 
+    is removed.
+    """
+    user = users.User('fred@example.com')
+    user2 = users.User('barney@example.com')
+    quoteid = models.add_quote('Hello, World!', user)
+    self.assertEqual(models.add_quote('  hello world', user2), quoteid)
+    self.assertEqual(models.add_or_find_quote('Hello world.', user2), (quoteid, False))
+    quotes, next = models.get_quotes_newest()
+    self.assertEqual(len(quotes), 1)
+
+    models.del_quote(quoteid, user)
+    quoteid2, added = models.add_or_find_quote('hello world', user2)
+    self.assertTrue(added)
+    self.assertNotEqual(quoteid2, None)
+    self.assertNotEqual(quoteid2, quoteid)
+    models.del_quote(quoteid2, user2)
+
+    # A fingerprint claimed for a quote that is still being stored isn't
+    # taken over until it is too old for the quote to be on its way.
+    self.assertEqual(models._claim_fingerprint('Pending quote.', 1000001), None)
+    self.assertEqual(models._claim_fingerprint('pending quote', 1000002), 1000001)
+    later = datetime.timedelta(seconds=models.DUPLICATE_CLAIM_GRACE + 1)
+    models._now = lambda: datetime.datetime.now() + later
+    try:
+      self.assertEqual(models._claim_fingerprint('pending quote', 1000002), None)
+    finally:
+      models._now = datetime.datetime.now
+
+  def test_near_duplicate_quotes(self):
+    """
+    With shingles on, a quote differing from an existing one by 
+    a word is also taken as a duplicate.
+    """
+    user = users.User('fred@example.com')
+    models.DUPLICATE_SHINGLES = True
+    try:
+      quoteid = models.add_quote(
+          'I told you the printer was possessed, it only jams when I need it.', user)
+      self.assertEqual(models.add_quote(
+          'I told you the printer was possessed, it only jams when I need it most.', user), 
+          quoteid)
+      quoteid2 = models.add_quote('My cat thinks the printer is possessed too.', user)
+      self.assertNotEqual(quoteid2, quoteid)
+      models.del_quote(quoteid, user)
+      models.del_quote(quoteid2, user)
+    finally:
+      models.DUPLICATE_SHINGLES = False
+
+    
+  def test_user_lists(self):
+    """
+    Each user's quotes and votes are listed newest first, and 
+    paged across the shards of the list.
+    """
+    user = users.User('fred@example.com')
+    user2 = users.User('barney@example.com')
+    ids = [models.add_quote('This is test %d.' % i, user) for i in range(5)]
+    models.set_vote(ids[1], user2, 1)
+    models.set_vote(ids[1], user2, -1)
+    models.set_vote(ids[3], user2, 1)
+    models.set_votes(user2, [(ids[0], 1), (ids[3], -1)])
+
+    quotes, extra = models.get_user_quotes(user2, 'votes')
+    self.assertEqual([q.key().id() for q in quotes], [ids[0], ids[3], ids[1]])
+    self.assertEqual(extra, None)
+    quotes, extra = models.get_user_quotes(user2, 'quotes')
+    self.assertEqual(quotes, [])
+
+    shard_size = models.USER_INDEX_SHARD_SIZE
+    models.USER_INDEX_SHARD_SIZE = models.PAGE_SIZE
+    try:
+      for i in range(9):
+        models._append_user_index('quotes', user.email(), ids)
+      pages = []
+      extra = None
+      while True:
+        quotes, extra = models.get_user_quotes(user, 'quotes', extra)
+        pages.append([q.key().id() for q in quotes])
+        if extra is None:
+          break
+    finally:
+      models.USER_INDEX_SHARD_SIZE = shard_size
+    self.assertEqual([len(page) for page in pages], [20, 20, 10])
+    self.assertEqual(sum(pages, []), list(reversed(ids)) * 10)
+
+    for quoteid in ids:
+      models.del_quote(quoteid, user)
+    quotes, extra = models.get_user_quotes(user, 'quotes')
+    self.assertEqual(quotes, [])
+
+    
+  def test_hot_quotes(self):
+    """
+    A quote with contended vote transactions is promoted to hot, its
+    votes are queued until drained, and it is demoted once it cools.
+    """
+    user = users.User('fred@example.com')
+    user2 = users.User('barney@example.com')
+    queue = models.vote_queue
+    models.vote_queue = models.LocalVoteQueue()
+    try:
+      quoteid = models.add_quote('This is test 0.', user, _created=1)
+      models._record_contention([quoteid], models.CONTENTION_THRESHOLD)
+      self.assertEqual(models.hot_quote_ids(), [])
+      models._record_contention([quoteid], 1)
+      self.assertEqual(models.hot_quote_ids(), [quoteid])
+
+      models.set_vote(quoteid, user, 1)
+      self.assertEqual(models.set_votes(user2, [(quoteid, 1)]), ['queued'])
+      self.assertEqual(models.get_quote(quoteid).votesum, 0)
+      self.assertEqual(models.voted(models.get_quote(quoteid), user), 1)
+
+      queued = {}
+      self.assertEqual(models.drain_votes(queued=queued), 2)
+      self.assertEqual(queued, {quoteid: 2})
+      self.assertEqual(models.get_quote(quoteid).votesum, 2)
+      # Still contended in this window.
+      models.cool_hot_quotes(queued)
+      self.assertEqual(models.hot_quote_ids(), [quoteid])
+
+      memcache.delete_multi(models._contention_keys(quoteid), 
+                            key_prefix=models.CONTENTION_PREFIX)
+      models.cool_hot_quotes({})
+      self.assertEqual(models.hot_quote_ids(), [])
+      self.assertEqual(models.contention_stats(), (1, 1, []))
+      models.set_vote(quoteid, user2, -1)
+      self.assertEqual(models.get_quote(quoteid).votesum, 0)
+    finally:
+      models.vote_queue = queue
+    models.del_quote(quoteid, user)
+
+  def test_quote_cache(self):
+    """
+    Quotes read by id come from the instance cache, then memcache, then
+    the datastore, and are dropped from the caches by votes and removals.
+    """
+    user = users.User('fred@example.com')
+    lock = models.QUOTE_CACHE_LOCK
+    models.QUOTE_CACHE_LOCK = 0
+    try:
+      ids = [models.add_quote('This is test %d.' % i, user, _created=1) for i in range(2)]
+      self.assertEqual(models.get_quote(ids[0]).quote, 'This is test 0.')
+      changed = models.Quote.get_by_id(ids[0])
+      changed.quote = 'Changed behind the cache.'
+      changed.put()
+      self.assertEqual(models.get_quote(ids[0]).quote, 'This is test 0.')
+      models._quote_cache.clear()
+      self.assertEqual(models.get_quote(ids[0]).quote, 'This is test 0.')
+      models._quote_cache.clear()
+      memcache.delete(models.QUOTE_CACHE_PREFIX + str(ids[0]))
+      self.assertEqual(models.get_quote(ids[0]).quote, 'Changed behind the cache.')
+
+      self.assertEqual(models.get_quote(ids[1]).votesum, 0)
+      models.set_vote(ids[1], user, 1)
+      self.assertEqual(models.get_quote(ids[1]).votesum, 1)
+      models._quote_cache.clear()
+      self.assertEqual(models.get_quote(ids[1]).votesum, 1)
+    finally:
+      models.QUOTE_CACHE_LOCK = lock
+    # A read that started before a write can't add back the old version.
+    models.set_vote(ids[1], user, -1)
+    self.assertFalse(memcache.add(models.QUOTE_CACHE_PREFIX + str(ids[1]), 'old'))
+    self.assertEqual(models.get_quote(ids[1]).votesum, -1)
+
+    models.del_quote(ids[0], user)
+    quotes = models.get_quotes_by_ids([ids[1], ids[0], ids[1]])
+    self.assertEqual(quotes[0].key().id(), ids[1])
+    self.assertEqual(quotes[1], None)
+    self.assertEqual(quotes[2].key().id(), ids[1])
+    models.del_quote(ids[1], user)
+    self.assertEqual(models.get_quote(ids[1]), None)
+
+    cache = models._LruCache(2, 60)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+  def test_list_refresh(self):
+    """
+    Cached list pages go stale when their section changes, are still 
+    served while stale, and are current again once refreshed.
+    """
+    user = users.User('fred@example.com')
+    first = models.add_quote('This is test 0.', user, _created=1)
+    quotes, extra, stale = models.get_list('recent')
+    self.assertEqual([q.key().id() for q in quotes], [first])
+    self.assertFalse(stale)
+    models.get_list('popular')
+
+    second = models.add_quote('This is test 1.', user, _created=1)
+    key = models._list_key('recent', None, None)
+    for i in range(2):
+      quotes, extra, stale = models.get_list('recent')
+      self.assertEqual([q.key().id() for q in quotes], [first])
+      self.assertTrue(stale)
+      self.assertNotEqual(memcache.get(models.LIST_REFRESH_PREFIX + key), None)
+    models.refresh_list('recent')
+    self.assertEqual(memcache.get(models.LIST_REFRESH_PREFIX + key), None)
+    quotes, extra, stale = models.get_list('recent')
+    self.assertEqual([q.key().id() for q in quotes], [second, first])
+    self.assertFalse(stale)
+
+    # A vote only changes the popular list.
+    models.refresh_list('popular')
+    models.set_vote(first, user, 1)
+    self.assertFalse(models.get_list('recent')[2])
+    self.assertTrue(models.get_list('popular')[2])
+
+    models.del_quote(first, user)
+    models.del_quote(second, user)
+
     
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,35 @@
+import ratelimit
+import unittest
+
+
+class TestRateLimit(unittest.TestCase):
+
+  def test_limits(self):
+    """
+    Requests over the limit of a user or an address are rejected
+    and counted, each user and address being limited separately.
+    """
+    limit = ratelimit.RateLimit('test', per_user=3, per_ip=5, period=60)
+    now = 6000.0
+    for i in range(3):
+      self.assertTrue(limit.allow('joe@example.com', '10.0.0.1', now=now))
+    self.assertFalse(limit.allow('joe@example.com', '10.0.0.2', now=now))
+    self.assertTrue(limit.allow('fred@example.com', '10.0.0.1', now=now))
+    self.assertFalse(limit.allow('barney@example.com', '10.0.0.1', cost=2, now=now))
+    self.assertTrue(limit.allow(None, '10.0.0.3', cost=5, now=now))
+
+  def test_sliding_window(self):
+    """
+    The count of the previous period is weighted by how much of it
+    is still within the last period.
+    """
+    limit = ratelimit.RateLimit('test', per_user=4, per_ip=None, period=60)
+    self.assertTrue(limit.allow('joe@example.com', None, cost=4, now=12059.0))
+    # Three quarters of the way into the next period a quarter of the 
+    # previous count, one request, still applies.
+    self.assertTrue(limit.allow('joe@example.com', None, cost=3, now=12105.0))
+    self.assertFalse(limit.allow('joe@example.com', None, now=12105.0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,37 @@
+import rpcstats
+import unittest
+
+from google.appengine.api import memcache
+
+
+class TestRpcStats(unittest.TestCase):
+
+  def setUp(self):
+    rpcstats._known_labels.clear()
+
+  def test_labels_merged(self):
+    """
+    Labels added by another instance are kept, and labels are only
+    known once they are in the memcache list.
+    """
+    stats = rpcstats.RequestStats()
+    stats.calls[('datastore_v3.Get', 'models.get_quote')] = [2, 100, 3.0]
+    rpcstats._record(stats)
+    self.assertTrue('datastore_v3.Get|models.get_quote' in rpcstats._known_labels)
+    # Another instance adds its own label.
+    labels = memcache.get(rpcstats._LABELS_KEY)
+    memcache.set(rpcstats._LABELS_KEY, labels + ['memcache.Get|main.other'])
+    stats = rpcstats.RequestStats()
+    stats.calls[('memcache.Set', 'models.set_quote')] = [1, 10, 1.0]
+    rpcstats._record(stats)
+    self.assertEqual(['datastore_v3.Get|models.get_quote',
+                      'memcache.Get|main.other',
+                      'memcache.Set|models.set_quote'],
+                     memcache.get(rpcstats._LABELS_KEY))
+    requests, totals = rpcstats.get_totals()
+    self.assertEqual(2, requests)
+    self.assertEqual(2, totals[0]['count'])
+
+
+if __name__ == '__main__':
+    unittest.main()